@@ -0,0 +1,267 @@
+import sys
+import argparse
+import subprocess
+
+
+# Function: command line entry point (python -m app <command> ...)
+#   Commands:
+#       insert          retrieve and insert the latest covid data (_bulk by default)
+#       delete          delete a single document by id
+#       delete-range    delete documents in a frm-to date range (all documents if no range)
+#       delete-index    delete the index
+#       query           run a named query from ES_Client.queries
+#       search          local SQL (or --where filters) over the curated data; no elasticsearch needed
+#       export          export to ES, BULK, KI or CSV
+#       rollup          recompute the <idx>-rollup summaries (per-state weekly/monthly, national daily)
+#       curate          curate (enrich) the covid data and write the exports/parquet store
+#       trend           least squares deathIncrease trend per state
+#       daemon          keep running: ingest/curate/export on a schedule in one warm process (see app/daemon.py)
+#       bench           time/memory of curate, export, getDFData, trends and a _bulk load on synthetic data (see app/bench.py)
+#       selftest        checks against local stubs, no elasticsearch needed (see app/selftest.py)
+#       check-imports   -X importtime regression check: fails when the index management commands import pandas/numpy/matplotlib/pyarrow or start too slowly
+#                       (only the app's own imports count: what elasticsearch pulls in, numpy/pandas when installed, is left out)
+#   Heavy modules are imported inside the commands that need them: index management commands never load
+#   pandas/numpy/matplotlib and never touch the covid feed
+#
+#   Use Cases:
+#       python -m app insert --threads 4
+#       python -m app delete-range --frm 20200320 --to 20200407
+#       python -m app query getMinDate --size 1
+#       python -m app search "select state, sum(deathIncrease) as deaths from covid group by state order by deaths desc limit 5"
+#       python -m app search --where state==NY "date>=20200401" --columns date state deathIncrease
+#       python -m app export CSV --fqp currentCovid.csv --frm 20200101
+#       python -m app trend --states NY CA --plot-dir data/export/plots
+#       python -m app daemon --ingest-every 900 --export-every 86400 --export CSV BULK
+#       python -m app bench --sizes 10000 100000 --memory --format prometheus
+#       python -m app selftest async
+#       python -m app check-imports
+
+heavyModules = ['pandas', 'numpy', 'matplotlib', 'pyarrow']  # must not be imported by the index management commands
+lightModules = ['app.__main__', 'app.covid']  # everything delete/delete-range/delete-index/query import
+externalPackages = ['elasticsearch']  # not counted by check-imports: elasticsearch 7.x's serializer imports numpy and pandas whenever they are installed
+maxImportMs = 250  # check-imports fails when the app's own share of those imports takes longer than this
+
+
+def getCovid(args):
+    from app.covid import Covid
+    return Covid(args.index, offline=getattr(args, 'offline', False))
+
+
+def doInsert(args):
+    return getCovid(args).doData(action='insertLatest', doc_type='_doc', bulk=not args.no_bulk, chunkSize=args.chunk_size, threads=args.threads, rollups=not args.no_rollup)
+
+
+def doDelete(args):
+    return getCovid(args).doData(action='deleteDoc', doc_id=args.doc_id)
+
+
+def doDeleteRange(args):
+    return getCovid(args).doData(action='deleteDocs', frm=args.frm, to=args.to, slices=args.slices, waitForCompletion=not args.no_wait)
+
+
+def doDeleteIndex(args):
+    return getCovid(args).doData(action='deleteIndex')
+
+
+def doQuery(args):
+    results = getCovid(args).doData(action='query', q=args.name, return_size=args.size, paging=args.paging)
+    for doc in results or []:
+        print(doc)
+    return results
+
+
+def doSearch(args):
+    import pandas as pd
+
+    results = getCovid(args).search(args.sql, where=args.where, columns=args.columns, orderBy=args.order_by, limit=args.limit)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(results)
+    return results
+
+
+def doExport(args):
+    return getCovid(args).doData(action='export', target=args.target, fqp=args.fqp, frm=args.frm)
+
+
+def doRollup(args):
+    return getCovid(args).doData(action='rollup')
+
+
+def doCurate(args):
+    return getCovid(args).curate(incremental=args.incremental, updateIndex=args.update_index)
+
+
+def doTrend(args):
+    import pandas as pd
+
+    trend = getCovid(args).getTrends(states=args.states, window=args.window, weights='linear' if args.weighted else None, plotDir=args.plot_dir)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(trend)
+    return trend
+
+
+def doDaemon(args):
+    from app.daemon import Covid_Daemon
+
+    schedule = {'ingest': args.ingest_every, 'curate': args.curate_every, 'export': args.export_every}
+    schedule = {name: seconds for name, seconds in schedule.items() if seconds > 0}  # 0 disables a job
+    if not schedule:
+        print("nothing to run: every job is disabled (set at least one of --ingest-every, --curate-every, --export-every above 0)")
+        return
+    return Covid_Daemon(args.index, schedule=schedule, exportTargets=args.export, offline=args.offline).run()
+
+
+def doBench(args):
+    from app import bench
+    from app.metrics import metrics
+
+    bench.run(args.sizes, traceMemory=args.memory, output=args.output if args.format == 'json' else None)
+    if args.format == 'prometheus':
+        print(metrics.toPrometheus(), end='')
+
+
+def doSelftest(args):
+    from app import selftest
+    return 1 if selftest.run(args.checks) else 0
+
+
+def doCheckImports(args):  # import what the index management commands import, under -X importtime, and check what the app itself pulls in
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(lightModules)], capture_output=True, text=True)
+    entries = []  # (nesting depth, module, cumulative us) in the order the imports finished; a module is listed after everything it imported
+    for line in proc.stderr.splitlines():  # "import time: self [us] | cumulative | imported package" (nested packages are indented)
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        name = fields[2].rstrip()
+        entries.append(((len(name) - len(name.lstrip())) // 2, name.strip(), int(fields[1])))
+
+    imported = set()  # modules imported by app code (directly or through anything but externalPackages)
+    totalUs = 0
+    ancestors = []
+    for depth, name, cumulativeUs in reversed(entries):  # walking backwards every module comes after its importer
+        while ancestors and ancestors[-1][0] >= depth:
+            ancestors.pop()
+        external = any(module.split('.')[0] in externalPackages for module in [name] + [module for d, module in ancestors])
+        if not external:
+            imported.add(name)
+            totalUs += cumulativeUs if depth == 0 else 0  # top level import; its cumulative time covers everything it pulled in
+        elif depth > 0 and not any(module.split('.')[0] in externalPackages for d, module in ancestors):
+            totalUs -= cumulativeUs  # an external package's subtree, counted in its app importer's cumulative time
+        ancestors.append((depth, name))
+
+    heavy = sorted(m for m in heavyModules if m in imported)
+    totalMs = round(totalUs / 1000)
+    print("imports: " + str(totalMs) + " ms without " + ", ".join(externalPackages) + " (limit " + str(args.max_ms) + " ms)")
+    if proc.returncode != 0:
+        print("FAIL: " + proc.stderr.splitlines()[-1])
+        return 1
+    if heavy:
+        print("FAIL: heavy modules imported: " + ", ".join(heavy))
+        return 1
+    if totalMs > args.max_ms:
+        print("FAIL: import time over the limit")
+        return 1
+    print("ok")
+    return 0
+
+
+def getParser():
+    parser = argparse.ArgumentParser(prog='python -m app', description='covid data loader for elasticsearch')
+    parser.add_argument('--index', default='covid-19', help='elasticsearch index (default: covid-19)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('insert', help='retrieve and insert the latest covid data')
+    cmd.add_argument('--no-bulk', action='store_true', help='index one document per request')
+    cmd.add_argument('--chunk-size', type=int, default=500)
+    cmd.add_argument('--threads', type=int, default=1)
+    cmd.add_argument('--no-rollup', action='store_true', help='do not refresh the <index>-rollup summaries')
+    cmd.add_argument('--offline', action='store_true', help='read data/source/covidExample.json instead of the network')
+    cmd.set_defaults(func=doInsert)
+
+    cmd = commands.add_parser('delete', help='delete a single document')
+    cmd.add_argument('doc_id')
+    cmd.set_defaults(func=doDelete)
+
+    cmd = commands.add_parser('delete-range', help='delete documents in a date range (all documents if no range)')
+    cmd.add_argument('--frm', default='', help='YYYYmmdd')
+    cmd.add_argument('--to', default='', help='YYYYmmdd')
+    cmd.add_argument('--slices', default='auto')
+    cmd.add_argument('--no-wait', action='store_true', help='run as a task and poll its progress')
+    cmd.set_defaults(func=doDeleteRange)
+
+    cmd = commands.add_parser('delete-index', help='delete the index')
+    cmd.set_defaults(func=doDeleteIndex)
+
+    cmd = commands.add_parser('query', help='run a named query (see ES_Client.queries)')
+    cmd.add_argument('name')
+    cmd.add_argument('--size', default='all', help='number of records to return (default: all)')
+    cmd.add_argument('--paging', default='scroll', choices=['scroll', 'pit'])
+    cmd.set_defaults(func=doQuery)
+
+    cmd = commands.add_parser('search', help='local SQL over the curated data (table: covid)')
+    cmd.add_argument('sql', nargs='?', default=None, help='select ... from covid ...; omit to use the filter options')
+    cmd.add_argument('--where', nargs='*', default=None, help='predicates, e.g. state==NY "date>=20200401" (ANDed; quote anything with > or <)')
+    cmd.add_argument('--columns', nargs='*', default=None)
+    cmd.add_argument('--order-by', default=None, help='column [asc|desc]')
+    cmd.add_argument('--limit', type=int, default=None)
+    cmd.set_defaults(func=doSearch)
+
+    cmd = commands.add_parser('export', help='export the covid data')
+    cmd.add_argument('target', choices=['ES', 'BULK', 'KI', 'CSV'])
+    cmd.add_argument('--fqp', default='', help='directory/filename (default: data/export/<frm>.<ext>)')
+    cmd.add_argument('--frm', default='', help='YYYYmmdd')
+    cmd.add_argument('--offline', action='store_true')
+    cmd.set_defaults(func=doExport)
+
+    cmd = commands.add_parser('rollup', help='recompute the <index>-rollup summaries')
+    cmd.add_argument('--offline', action='store_true')
+    cmd.set_defaults(func=doRollup)
+
+    cmd = commands.add_parser('curate', help='enrich the covid data and write the exports')
+    cmd.add_argument('--incremental', action='store_true', help='only new/changed documents')
+    cmd.add_argument('--update-index', action='store_true', help='also upsert the curated documents into the index')
+    cmd.add_argument('--offline', action='store_true')
+    cmd.set_defaults(func=doCurate)
+
+    cmd = commands.add_parser('trend', help='least squares deathIncrease trend per state')
+    cmd.add_argument('--states', nargs='*', default=None)
+    cmd.add_argument('--window', type=int, default=None, help='fit only the most recent n days')
+    cmd.add_argument('--weighted', action='store_true', help='recent days weigh more')
+    cmd.add_argument('--plot-dir', default=None, help='render one png per state into this directory')
+    cmd.set_defaults(func=doTrend)
+
+    cmd = commands.add_parser('daemon', help='run ingest/curate/export on a schedule in one long running process')
+    cmd.add_argument('--ingest-every', type=int, default=3600, help='seconds between ingests (0 disables)')
+    cmd.add_argument('--curate-every', type=int, default=3600, help='seconds between incremental curates (0 disables)')
+    cmd.add_argument('--export-every', type=int, default=86400, help='seconds between exports (0 disables)')
+    cmd.add_argument('--export', nargs='*', default=['CSV'], choices=['ES', 'BULK', 'KI', 'CSV'])
+    cmd.add_argument('--offline', action='store_true')
+    cmd.set_defaults(func=doDaemon)
+
+    cmd = commands.add_parser('bench', help='benchmark the hot paths on synthetic data')
+    cmd.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000], help='records per run')
+    cmd.add_argument('--memory', action='store_true', help='also capture the tracemalloc peak of each stage (slower)')
+    cmd.add_argument('--format', default='json', choices=['json', 'prometheus'])
+    cmd.add_argument('--output', default='-', help='json lines file (default: stdout)')
+    cmd.set_defaults(func=doBench)
+
+    cmd = commands.add_parser('selftest', help='run the checks against local stubs (exits non zero on a failure)')
+    cmd.add_argument('checks', nargs='*', default=None, help='checks to run (default: all; see app/selftest.py)')
+    cmd.set_defaults(func=doSelftest)
+
+    cmd = commands.add_parser('check-imports', help='fail if index management commands import heavy modules or start slowly')
+    cmd.add_argument('--max-ms', type=int, default=maxImportMs)
+    cmd.set_defaults(func=doCheckImports)
+    return parser
+
+
+def main(argv=None):
+    args = getParser().parse_args(argv)
+    result = args.func(args)
+    if args.command in ('check-imports', 'selftest'):
+        return result
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
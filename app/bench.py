@@ -0,0 +1,123 @@
+import os
+import csv
+import random
+import hashlib
+import datetime
+import tempfile
+
+from app.metrics import metrics
+from app.records import CovidRecord
+from app.selftest import startStubES
+
+
+# Function: benchmark of the hot paths on synthetic data (python -m app bench)
+#   For each dataset size a synthetic all-state daily history is generated (same fields/sentinels as the feed) and run through:
+#       curate, export (ES, BULK, KI, CSV), getDFData, getTrends (doLR for every state) and both index paths into a local stub
+#       elasticsearch (app.selftest.StubES, answering _bulk and single document requests): one request per document
+#       (ES_Client.insert, capped at perDocMax docs) and _bulk (ES_Client.bulkInsert), all inside a temporary directory
+#   every step is a metrics stage, so results come out as json lines (or Prometheus text) like the rest of the instrumentation;
+#   the docs/sec of both index paths and the curate scaling (microseconds per record of the population join + derived columns
+#   and of the full curate at every size, relative to the smallest size; flat means linear) are printed at the end
+#   the synthetic data is a multi-year all-state history: 100000 records is ~5 years of daily records for every state
+#
+#   Use Case:
+#       python -m app bench --sizes 10000 100000 1000000 --memory
+
+perDocMax = 5000  # docs sent through the one request per document path (it is far too slow for the larger sizes)
+
+
+def getStates():  # state digraphs from the population table (skip the US total)
+    with open('data/source/populationByState_2019.csv') as statePop:
+        return [rows['digraph'] for rows in csv.DictReader(statePop) if rows['digraph'] != 'US']
+
+
+def makeDataset(size, seed=0):  # synthetic daily records for every state, newest first (like the feed)
+    rnd = random.Random(seed)
+    states = getStates()
+    days = max(1, size // len(states) + 1)
+    start = datetime.date(2020, 1, 1)
+    covidAry = []
+    for day in range(days - 1, -1, -1):
+        date = int((start + datetime.timedelta(days=day)).strftime('%Y%m%d'))
+        for state in states:
+            if len(covidAry) >= size:
+                return covidAry
+            death = day * rnd.randint(0, 20)
+            positive = death * rnd.randint(5, 40)
+            covidAry.append({
+                'date': date, 'state': state, 'positive': positive, 'negative': positive * 4, 'pending': 'None',
+                'hospitalizedCurrently': 'None', 'hospitalizedCumulative': positive // 7 if rnd.random() > 0.2 else 'None',
+                'inIcuCurrently': 'None', 'inIcuCumulative': positive // 30 if rnd.random() > 0.5 else 'None',
+                'onVentilatorCurrently': 'None', 'onVentilatorCumulative': 'None', 'recovered': 'None',
+                'hash': hashlib.sha1((state + str(date)).encode()).hexdigest(), 'dateChecked': str(date) + 'T20:00:00Z',
+                'death': death, 'hospitalized': 'None', 'total': positive * 5, 'totalTestResults': positive * 5, 'posNeg': positive * 5,
+                'fips': '00', 'deathIncrease': rnd.randint(-2, 30), 'hospitalizedIncrease': 0, 'negativeIncrease': 0,
+                'positiveIncrease': rnd.randint(0, 300), 'totalTestResultsIncrease': 0,
+            })
+    return covidAry
+
+
+def run(sizes, traceMemory=False, output='-'):
+    from app.covid import Covid
+    from app.dao.ES_Client import ES_Client
+
+    metrics.configure(output=output, traceMemory=traceMemory)
+    server = startStubES(store=False)  # documents are acknowledged, not kept
+    ES_Client.sharedClient = None  # point the shared client at the stub
+    savedHosts = os.environ.get('ES_HOSTS')
+    os.environ['ES_HOSTS'] = '127.0.0.1:' + str(server.server_port)
+
+    try:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                covid = Covid('bench', offline=True)
+                covid.exportPath = os.path.join(tmp, 'currentCovid.json')
+                covid.storePath = os.path.join(tmp, 'currentCovid.parquet')
+                covid.manifestFile = os.path.join(tmp, 'curateManifest.json')
+                with metrics.stage('bench.generate', size=size):
+                    covid.covidAry = makeDataset(size)
+                with metrics.stage('bench.curate', size=size):
+                    covid.curate()
+                with metrics.stage('bench.curateJoin', size=size):
+                    covid.getCuratedFrame()  # population join and derived columns only (no exports/parquet writes)
+                for target in ('ES', 'BULK', 'KI', 'CSV'):
+                    with metrics.stage('bench.export', size=size, target=target):
+                        covid.doData(action='export', target=target, fqp=os.path.join(tmp, 'export' + target), frm='20200101')
+                with metrics.stage('bench.getDFData', size=size):
+                    covid.getDFData(covid.covidDF, ['state==NY', '0:' + str(size // 2)], ['date', 'state', 'deathIncrease'])
+                with metrics.stage('bench.trends', size=size):
+                    covid.getTrends()
+                perDoc = covid.covidAry[:perDocMax]
+                with metrics.stage('bench.index', size=size, mode='perDoc', docs=len(perDoc)):
+                    covid.esClient.insert('_doc', [doc.toDict() for doc in perDoc])
+                with metrics.stage('bench.index', size=size, mode='bulk', docs=len(covid.covidAry)):
+                    covid.esClient.bulkInsert('_doc', map(CovidRecord.toDict, covid.covidAry), threads=4)
+    finally:
+        server.shutdown()
+        ES_Client.sharedClient = None  # the next client goes back to the configured hosts
+        if savedHosts is None:
+            os.environ.pop('ES_HOSTS', None)
+        else:
+            os.environ['ES_HOSTS'] = savedHosts
+    printRates(metrics.records)
+    printScaling(metrics.records)
+    return metrics.records
+
+
+def printRates(records):  # docs/sec of the per document and _bulk index paths, per dataset size
+    print("index path docs/sec:")
+    for record in records:
+        if record['stage'] == 'bench.index' and record['seconds'] > 0:
+            labels = record['labels']
+            print("  size " + str(labels['size']) + " " + labels['mode'] + ": " + str(labels['docs']) + " docs in " + str(round(record['seconds'], 3))
+                  + " s, " + str(round(labels['docs'] / record['seconds'], 1)) + " docs/sec")
+
+
+def printScaling(records):  # curate cost per record at every size; the ratio to the smallest size stays near 1.0 when curate scales linearly
+    print("curate scaling (us/record, ratio to the smallest size):")
+    for stage in ('bench.curateJoin', 'bench.curate'):
+        perRecord = [(record['labels']['size'], record['seconds'] * 1e6 / record['labels']['size']) for record in records if record['stage'] == stage]
+        if not perRecord:
+            continue
+        base = perRecord[0][1]
+        print("  " + stage + ": " + ", ".join(str(size) + ": " + str(round(us, 2)) + " (" + str(round(us / base, 2)) + "x)" for size, us in perRecord))
@@ -1,19 +1,29 @@
 import os
+import re
 import json
 import csv
 import sys
+import uuid
+import shutil
 
-import requests
 import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
 from app.dao.ES_Client import ES_Client
+from app.dao.Feed_Client import Feed_Client
+from app.exporters import exporters
+from app.records import fromDocs, toColumns
+from app.localsql import LocalSQL, toSQL, toESQuery, getNeeded
+from app.sources import sources, defaultFiles, ingest
+from app.metrics import metrics
 
 # Function: client interface to local elasticsearch instance
 #   Specific Functions:
 #         On __init__
-#           Retrieve covid data via URL request and place in a global array as json documents
 #           Instantiate elasticsearch client with index configuration
+#           Configure the covid data feed (Feed_Client); data is retrieved via URL request on first use of covidAry
+#               cached on disk (data/cache/) and revalidated with ETag/Last-Modified once the ttl expires
+#               Covid('covid-19', offline=True) reads data/source/covidExample.json instead of the network
+#               decoded straight into compact CovidRecord tuples with real nulls (app/records.py); dictionaries are only built per
+#               document at the edges (export writers, _bulk chunks)
 #         On call
 #           setKwargs()
 #               called when doData() is called
@@ -30,16 +40,44 @@ from app.dao.ES_Client import ES_Client
 #           Execute scroll queries
 #               configure return size (optional)
 #               only need to pass a query name (name looked up in queries dictionary on ES_Client
-#           Export data formatted as:
+#         every doData action, curate/export stage, feed fetch and _bulk load is timed through app/metrics.py (json lines or Prometheus text)
+#         numpy/pandas (and matplotlib) are imported inside the methods that use them so index management stays fast to start
+#           Export data formatted as (streamed one document at a time, see app/exporters.py):
+#               once curate() has run, export/insertLatest/rebuild stream the curated rows of covidDF (dateTrack, per-capita and
+#               mortality fields included); before that the feed records as they are
 #               Kibana.json (can be imported by Kibana import tool)
 #               Elasticsearch.json (standard elasticsearch format)
+#               Elasticsearch _bulk.ndjson (can be posted to the _bulk api)
 #               CSV (with headers)
 #
 #   Input Params:
 #           action (required)
 #               insertLatest
-#                   Params: action='insertLatest'
+#                   Params: action='insertLatest', doc_type='_doc', bulk=True, chunkSize=500, threads=1
 #                   insert most recent data NOT currently in elasticsearch instance
+#                   bulk, chunkSize, threads optional; bulk defaults to True (_bulk api), set bulk=False to index one document per request
+#                   returns a dictionary of attempted/indexed/skipped/failed counts (failures grouped by reason), docs/sec and resulting index size when bulk=True
+#                   the index is created from config/covid-template.json (explicit compact mapping) when it does not exist
+#                   rollups optional; defaults to True: the <idx>-rollup summaries of the weeks/months/days the new documents fall in are recomputed (see rollup)
+#               insertSources
+#                   Params: action='insertSources', sources=['covidtracking', 'owid', 'cdc', 'population'], workers=4, threads=1
+#                   sources, workers, threads optional; defaults to all sources, one parser process per source
+#                   parse each source (see app/sources.py) in its own process, normalize to a common document schema and
+#                   stream the documents through a bounded queue into a _bulk load of the <idx>-sources index
+#               rebuild
+#                   Params: action='rebuild', doc_type='_doc', chunkSize=500, threads=4
+#                   doc_type, chunkSize, threads optional
+#                   bulk load the full dataset into a new versioned index (<idx>-YYYYmmddHHMMSS) with the bulk load profile,
+#                   then atomically swap the <idx> alias to it and drop the old index (dashboards never see an empty index)
+#               reindex
+#                   Params: action='reindex', slices='auto'
+#                   slices optional
+#                   server side _reindex of the current data into a new versioned index (current template/mapping), then swap the alias
+#               rollup
+#                   Params: action='rollup'
+#                   recompute every summary in the <idx>-rollup companion index: per-state weekly and monthly, and national daily
+#                   sums of deaths/cases/hospitalizations plus the cumulative counts and per-capita/mortality rates as of each period's
+#                   last day (a few thousand documents for dashboards instead of the full daily history)
 #               deleteIndex
 #                   Params: action='deleteIndex'
 #                   deletes the default index defined in the global index variable
@@ -48,21 +86,24 @@ from app.dao.ES_Client import ES_Client
 #                   doc_id required
 #                   deletes a single document
 #               deleteDocs
-#                   Params: action='deleteDocs', frm='20200301', to='20200401'
+#                   Params: action='deleteDocs', frm='20200301', to='20200401', slices='auto', waitForCompletion=True
 #                   frm-to date range optional
-#                   delete a set/range of documents matching frm-to date range
+#                   delete a set/range of documents matching frm-to date range (one server side _delete_by_query request)
 #                   deletes all documents if no frm-to date range provided
+#                   slices, waitForCompletion optional; waitForCompletion=False runs the delete as a task and polls its progress
+#                   returns a summary of matched/deleted docs
 #               query
-#                   Params: action='query', q='name of query', return_size='1'
+#                   Params: action='query', q='name of query', return_size='1', paging='scroll'
 #                   return_size optional; defaults to 'all'
+#                   paging optional; 'scroll' (default) or 'pit' (point in time + search_after)
 #                   set return_size to modulate the number of records to return
 #                   scroll based query returning a record set structured as an array of dictionaries
 #               export
 #                   Params: action='export', target='typeOfExport', fqp='fully qualified path'
 #                       target (required)
-#                           options: 'CSV', 'KI' (kibana importable), 'ES' (standard elasticsearch format)
+#                           options: 'CSV', 'KI' (kibana importable ndjson), 'ES' (standard elasticsearch format), 'BULK' (elasticsearch _bulk format)
 #                       fqp (optional)
-#                           default: DataLayer/Data/export/YYYYmmdd.fileExtension (file extension set based on target selection)
+#                           default: data/export/YYYYmmdd.fileExtension (file extension set based on target selection)
 #                           fqp='directory/filename'
 #                       fromDate (optional)
 #                           specify the starting point in time to export (e.g. 20200301)
@@ -70,9 +111,18 @@ from app.dao.ES_Client import ES_Client
 
 class Covid:
     esClient = ""  # elasticsearch client
-    data = ""  # temp holder for data retrieved from covid site
-    jsonAry = []  # temp array for json data (used in export as a differential holder for covidAry)
-    covidAry = []  # temp array for json data
+    feed = ""  # upstream covid data feed client (cached, revalidated, or offline snapshot)
+    _covidAry = None  # array of CovidRecord from the feed (loaded on first access of covidAry)
+    covidDF = None  # curated, typed DataFrame built from covidAry (set in curate)
+    storeDF = None  # in memory copy of the parquet store; kept when covidAry is replaced so incremental curate never re-reads the store
+    exportPath = 'data/export/currentCovid.json'  # curated json export (written by curate)
+    storePath = 'data/export/currentCovid.parquet'  # parquet dataset partitioned by state (written by curate)
+    manifestFile = 'data/export/curateManifest.json'  # last curated watermark and state|date -> hash manifest (used by curate(incremental=True))
+    docsChunkRows = 10000  # curated rows turned into documents at a time (frameToDocs)
+    rateDtype = 'float64'  # dtype of the derived per-capita/mortality columns; float64 keeps values identical to the per-document calculation
+    countFields = ['positive', 'negative', 'pending', 'hospitalizedCurrently', 'hospitalizedCumulative', 'inIcuCurrently', 'inIcuCumulative',
+                   'onVentilatorCurrently', 'onVentilatorCumulative', 'recovered', 'death', 'hospitalized', 'total', 'totalTestResults', 'posNeg',
+                   'positiveIncrease', 'negativeIncrease', 'totalTestResultsIncrease', 'deathIncrease', 'hospitalizedIncrease']  # integer count fields in the feed
     dt = datetime.datetime(2019, 1, 1)  # set default date well prior to covid event
     startDate = dt.strftime('%Y') + dt.strftime('%m') + dt.strftime('%d')  # default to 20190101
 
@@ -81,22 +131,46 @@ class Covid:
     action = ""  # action to be performed
     doc_id = ""  # id of a specific document (used in deleteDoc)
     doc_type = "_doc"
+    bulk = True  # use the _bulk api for insertLatest (set bulk=False to index one document per request)
+    chunkSize = 500  # docs per _bulk request (used in insertLatest)
+    threads = 1  # number of parallel _bulk workers (used in insertLatest, insertSources)
+    bulkProfileMin = 5000  # loads of at least this many docs switch the index to the bulk load profile (refresh_interval=-1, replicas=0) while they run
+    sqlEngine = None  # local SQL engine used by search: 'duckdb', 'sqlite' or None (duckdb when installed, otherwise sqlite)
+    rollups = True  # refresh the affected <idx>-rollup summaries after insertLatest
+    rollupSuffix = '-rollup'  # companion index of per-state weekly/monthly and national daily summaries
+    rollupSums = ['deathIncrease', 'positiveIncrease', 'hospitalizedIncrease']  # summed over a rollup period
+    rollupLatest = ['death', 'positive', 'hospitalizedCumulative', 'inIcuCumulative', 'deathPerCapita', 'hospitalizedPerCapita',
+                    'icuPerCapita', 'mortalityRate']  # cumulative counts and rates as of the last reported day of a period
+    sources = []  # names of the source adapters to load (used in insertSources)
+    workers = None  # number of parser processes; defaults to one per source (used in insertSources)
     q = ""  # the body of a query
     return_size = "all"
+    paging = "scroll"  # query paging strategy: scroll or pit (point in time + search_after)
     target = ""  # a target data format (ES, KI, CSV) used in export
     fqp = ""  # a fully qualified path (used in export)
     fromDate = ""  # from date (used in export)
     frm = ""  # from date (used in deleteDocs date range)
     to = ""  # to date (used in deleteDocs date range)
+    slices = "auto"  # number of parallel slices (used in deleteDocs)
+    waitForCompletion = True  # block until the delete finishes; False runs it as a task and polls progress (used in deleteDocs)
     msg = ""  # message printed to user
     # global params
 
-    def __init__(self, idx):
+    def __init__(self, idx, **kwargs):  # kwargs passed to Feed_Client: offline=True (read local snapshot), ttl=seconds (cache lifetime), cacheDir, snapshot, url
         self.idx = idx  # elasticsearch index
         self.esClient = ES_Client(self.idx)  # elasticsearch client (configured with index)
-        self.data = requests.get('https://api.covidtracking.com/v1/us/daily.json').content  # retrieve the latest data
-        # print(self.data)
-        self.covidAry = json.loads(self.data)  # place in array of JSON objects
+        self.feed = Feed_Client(**kwargs)  # nothing is downloaded until covidAry is first used
+
+    @property
+    def covidAry(self):  # array of CovidRecord (compact typed records, see app/records.py) from the feed; fetched (or read from cache/snapshot) on first access
+        if self._covidAry is None:
+            self._covidAry = self.feed.load()
+        return self._covidAry
+
+    @covidAry.setter
+    def covidAry(self, value):  # feed dictionaries are converted to CovidRecord in place
+        self._covidAry = fromDocs(value)
+        self.covidDF = None  # curated from the previous data; export/insertLatest go back to the records until the next curate
 
     def setKwargs(self, **kwargs):  # unpack and analyze keyword arguments and set passed == True/False accordingly; if False, stop execution and print message (self.msg) to user
         passed = True
@@ -116,6 +190,7 @@ class Covid:
                     self.return_size = kwargs['return_size']
                 except:
                     pass
+                self.paging = kwargs.get('paging', 'scroll')  # paging optional (scroll or pit)
 
             elif self.action == 'deleteDoc':
                 try:
@@ -132,16 +207,21 @@ class Covid:
                 except:
                     self.msg += "you must pass a doc_type\n"
                     passed = False
-
-            elif self.action == 'deleteDocs':
-                try:
-                    var = kwargs['frm']
-                    self.frm = kwargs['frm']
-                    var = kwargs['to']
-                    self.to = kwargs['to']
-                except:
-                    self.msg += "cannot determine date range between " + self.frm + " and " + self.to + "\n"
-                    passed = False
+                self.bulk = kwargs.get('bulk', True)  # bulk, chunkSize, threads and rollups optional
+                self.chunkSize = kwargs.get('chunkSize', self.chunkSize)
+                self.threads = kwargs.get('threads', self.threads)
+                self.rollups = kwargs.get('rollups', self.rollups)
+
+            elif self.action == 'deleteDocs':  # frm-to date range optional; no range deletes all documents
+                self.frm = str(kwargs.get('frm', ''))
+                self.to = str(kwargs.get('to', ''))
+                for d in (self.frm, self.to):
+                    if d != '' and (not d.isnumeric() or len(d) != 8):  # date must be 8 digit long integer
+                        self.msg += "cannot determine date range between " + self.frm + " and " + self.to + "\n"
+                        passed = False
+                        break
+                self.slices = kwargs.get('slices', 'auto')  # slices and waitForCompletion optional
+                self.waitForCompletion = kwargs.get('waitForCompletion', True)
 
             elif self.action == 'export':
                 try:
@@ -162,14 +242,34 @@ class Covid:
                 except:  # fromDate optional
                     pass
 
+            elif self.action == 'rebuild':  # doc_type, chunkSize and threads optional
+                self.doc_type = kwargs.get('doc_type', self.doc_type)
+                self.chunkSize = kwargs.get('chunkSize', self.chunkSize)
+                self.threads = kwargs.get('threads', 4)
+
+            elif self.action == 'reindex':  # slices optional
+                self.slices = kwargs.get('slices', 'auto')
+
+            elif self.action == 'insertSources':  # sources, workers and threads optional
+                self.sources = kwargs.get('sources', ['covidtracking'] + list(defaultFiles))
+                self.workers = kwargs.get('workers', None)
+                self.threads = kwargs.get('threads', self.threads)
+                unknown = [name for name in self.sources if name not in sources]
+                if unknown:
+                    self.msg += "unknown source(s) " + ", ".join(unknown) + "; options: [" + ", ".join(sources) + "]\n"
+                    passed = False
 
         except:
-            self.msg += "action must be set to one of the following [insertLatest, deleteIndex, deleteDoc, deleteDocs, query, export ]\n"
+            self.msg += "action must be set to one of the following [insertLatest, insertSources, rebuild, reindex, rollup, deleteIndex, deleteDoc, deleteDocs, query, export ]\n"
             passed = False
 
         return passed
 
-    def doData(self, **kwargs):  # execute requested action
+    def doData(self, **kwargs):  # execute requested action (timed as a 'doData' stage, see app/metrics.py)
+        with metrics.stage('doData', action=str(kwargs.get('action', ''))):
+            return self.runAction(**kwargs)
+
+    def runAction(self, **kwargs):
         self.msg = ""
         if not self.setKwargs(**kwargs):
             print(self.msg)  # something wrong with arguments; passed = False; end execution with a print out of error
@@ -181,10 +281,47 @@ class Covid:
             if self.esClient.checkIndex(self.idx):  # check if index exists prior to setting start date; if no index, no need to set start date
                 self.setStartDate()  # get and set the highest date found in the covid-19 dataset
 
-            for doc in self.covidAry:  # iterate over array of dictionaries
-                if int(doc['date']) > int(self.startDate):  # only write documents with a date greater than startDate (startDate defaulted to 20190101 if not set)
+            startDate = int(self.startDate)
+            for doc in self.covidAry:  # iterate over array of records
+                if doc.date > startDate:  # only write documents with a date greater than startDate (startDate defaulted to 20190101 if not set)
                     dataset.append(doc)
-            self.esClient.insert('_doc', dataset)  # send to ES_Client for insert
+            if self.bulk:  # send to ES_Client for _bulk insert; returns counts of indexed, skipped and failed docs
+                self.esClient.createIndex()  # explicit mapping from config/covid-template.json (no-op if the index exists)
+                saved = None
+                if len(dataset) >= self.bulkProfileMin:  # large load: no refresh and no replicas until it is done
+                    saved = self.esClient.setBulkProfile()
+                try:
+                    counts = self.esClient.bulkInsert(self.doc_type, self.getDocs(startDate, after=True), chunkSize=self.chunkSize, threads=self.threads)  # one dictionary per document, built as each chunk is sent
+                finally:
+                    if saved is not None:
+                        self.esClient.restoreProfile(saved)
+                counts.update(self.esClient.getIndexStats())  # resulting index doc count and size
+                print("index size: " + str(counts['sizeInBytes']) + " bytes, " + str(counts['docs']) + " docs")
+                if self.rollups and counts['indexed'] > 0:  # only the periods the new documents fall in are recomputed
+                    counts['rollup'] = self.rollup(dataset)
+                return counts
+            self.esClient.insert(self.doc_type, list(self.getDocs(startDate, after=True)))  # send to ES_Client for insert (one request per document)
+            if self.rollups and dataset:
+                self.rollup(dataset)
+
+        elif self.action == "insertSources":  # parse every source concurrently and bulk load them into the <idx>-sources index
+            files = {}
+            for name in self.sources:
+                if name == 'covidtracking':
+                    self.covidAry  # make sure the feed has been fetched (and cached) before a worker reads it
+                    files[name] = self.feed.snapshot if self.feed.offline else self.feed.cacheFile
+                else:
+                    files[name] = defaultFiles[name]
+            return ingest(ES_Client(self.idx + '-sources'), files, workers=self.workers, threads=self.threads)
+
+        elif self.action == "rebuild":  # full refresh into a new versioned index; readers keep using the old one until the alias swap
+            return self.esClient.rebuild(self.doc_type, self.getDocs(), chunkSize=self.chunkSize, threads=self.threads)
+
+        elif self.action == "reindex":  # re-map the existing data server side (no download)
+            return self.esClient.reindex(slices=self.slices)
+
+        elif self.action == "rollup":  # recompute every summary in the <idx>-rollup index
+            return self.rollup()
 
         elif self.action == "deleteIndex":
             self.esClient.deleteIndex()
@@ -192,15 +329,13 @@ class Covid:
         elif self.action == "deleteDoc":
             self.esClient.deleteDoc(self.doc_id)
 
-        elif self.action == "deleteDocs":
-            for doc in self.covidAry:
-                if int(self.frm) <= int(doc['date']) <= int(self.to):
-                    self.esClient.deleteDoc(doc['hash'])
+        elif self.action == "deleteDocs":  # single server side _delete_by_query on the date field; returns a summary of deleted docs
+            return self.esClient.deleteRange(self.frm, self.to, slices=self.slices, waitForCompletion=self.waitForCompletion)
 
         elif self.action == "query":
             # query = {"query": {"range": { "date": {"gt": 20200101}}},"size":10000}
             # ***NOTE: all queries are defined in a dictionary on ES_Client.py, set 'q' equal to the name of the query
-            results = self.esClient.query(q=self.q, return_size=self.return_size)
+            results = self.esClient.query(q=self.q, return_size=self.return_size, paging=self.paging)
             return results
 
         elif self.action == 'export':
@@ -209,9 +344,9 @@ class Covid:
         print(self.msg)
 
     def setStartDate(self):  # find and set the maximum data found in covid-19 ES instance
-        results = self.esClient.query(q='getMaxDate', return_size=1)
-        if len(results) > 0:  # found data in covid-19 instance; if none found go with default startDate of one year ago (to capture all data)
-            self.startDate = results[0]['date']
+        maxDate = self.esClient.summary('date', ['max'])['max']  # single max aggregation; no sort or scroll over the index
+        if maxDate is not None:  # found data in covid-19 instance; if none found go with default startDate of one year ago (to capture all data)
+            self.startDate = str(int(maxDate))
         print("startDate: ", self.startDate)
 
     def export(self):
@@ -222,16 +357,16 @@ class Covid:
                 print("Incorrect Date Format: Date must be in YYYYmmdd format (e.g. 20200301)")
                 return
 
-        self.jsonAry.clear()
-
-        defaultDir = 'DataLayer/Data/export/'
+        if self.target not in exporters:
+            print("Unknown export target: " + self.target + " (options: " + ", ".join(exporters) + ")")
+            return
+        exporter = exporters[self.target]
 
-        fileType = '.json'
-        if self.target == 'CSV':
-            fileType = '.csv'
+        defaultDir = 'data/export/'
+        fileType = exporter.fileType
 
         if self.fqp == '':  # just set to default directory and file name
-            set.fqp = 'DataLayer/Data/export/' + self.fromDate + fileType
+            self.fqp = defaultDir + self.fromDate + fileType
         else:  # fix it up if needed
             if self.fqp.find("/") < 0:  # no directory specified, set to default directory
                 self.fqp = defaultDir + self.fqp
@@ -239,227 +374,552 @@ class Covid:
             if self.fqp.find(".") < 0:  # file extension missing, tack it on the end
                 self.fqp += fileType
 
-        if os.path.exists(self.fqp):  # if the export file exists remove it
-            os.remove(self.fqp)
-
+        docs = self.getDocs(self.fromDate)  # stream the matching documents straight into the writer (no intermediate copies)
         try:
-            exportFile = open(self.fqp, 'a')  # create an appendable export file
+            with metrics.stage('export', target=self.target):
+                numRecords = exporter(self.fqp, idx=self.idx).write(docs)  # overwrites any existing export file
+                metrics.count('export.records', numRecords)
         except Exception as fileEx:  # directory doesn't exist; stop processing
             print("File Exception: ", fileEx)
             return
-        numRecords = 0
-        # file directory, name, and extension all configured; build the export contents
-        if self.target == "KI":  # create a KI happy json file (everything in quotes, dictionaries separated by new lines, fix the dateChecked field)
-            for doc in self.covidAry:
-                if int(doc['date']) >= int(self.fromDate):
-                    self.jsonAry.append(str(doc).replace("'", '"'))  # create an array hosting each JSON document from original file (and get rid of all ' marks)
-
-            newLine = ""
-            for d in self.jsonAry:  # iterate and fix/reconstruct each JSON document
-                line = d.replace("{", "").replace("}", "")  # remove the {} brackets (we'll put them back in at the right time)
-                line = line.split(",")  # get each key/value pair
-                for el in line:  # iterate key/value pairs
-                    elData = el.split(":")  # separate key from value and place in an array (so we can 'work' on each value)
-                    if elData[1].find('\"') < 0:  # look for quotes in each value, if quotes not found, add them (and remove white-space)
-                        elData[1] = '"' + elData[1].strip() + '"'
-
-                    if elData[0].find("dateChecked") > 0:  # the dateChecked field has ':' in it so the previous split(':') method truncated this value -- fix it
-                        elData[1] += ":00:00Z\""  # during key/value split on ":", :00:00Z was truncated off each dateChecked value, put it back on (with a trailing quote)
-                    newLine += elData[0] + ":" + elData[1] + ","  # rebuild a new line by adding each key/value pair
-                newLine = "{" + newLine[0:len(newLine) - 1] + "}\n"  # encase the line in {}, remove the trailing comma, and add a new line '\n'
-                exportFile.write(newLine)  # write this line into the new covid file
-                newLine = ""  # clear newLine for the next iteration
-
-            numRecords = len(self.jsonAry)
-
-        elif self.target == "ES":
-            data = ""
-            for doc in self.covidAry:
-                if int(doc['date']) >= int(self.fromDate):
-                    data += str(doc) + ","
-            exportFile.write("[" + data.replace("'", '"').replace("None", "\"None\"").rstrip(",") + "]")
-
-            numRecords = len(self.covidAry)
-
-        elif self.target == "CSV":
-            for doc in self.covidAry:
-                if int(doc["date"]) >= int(self.fromDate):
-                    self.jsonAry.append(doc)
-
-            headers = self.jsonAry[0].keys()
-            writer = csv.DictWriter(exportFile, headers)
-            writer.writeheader()
-            writer.writerows(self.jsonAry)
-
-            numRecords = len(self.jsonAry)
-
-        self.msg += "Exported " + str(numRecords) + " records to: " + os.path.abspath(os.path.dirname(__file__)) + "/" + self.fqp
-
-    def curate(self):
-        tmpAry = []
-        covidNewAry = []
-        with open('data/source/populationByState_2019.csv') as statePop:
-            reader = csv.DictReader(statePop)
-            for rows in reader:
-                for doc in self.covidAry:
-                    if rows['digraph'] == doc['states']:
-                        dateSrt = str(doc['date'])
-                        y = dateSrt[0:4]
-                        m = dateSrt[4:6]
-                        d = dateSrt[6:8]
-                        doc['dateTrack'] = y + '-' + m + '-' + d + 'T12:00:00Z'
-
-                        try:
-                            var = doc['deathIncrease']
-                            if int(doc['deathIncrease']) < 0:  # at times states will publish a negative death increase to adjust for reporting errors; kibana throws a wobbly when this value is < 0
-                                doc['deathIncrease'] = 0  # set values < 0 to 0
-                        except:
-                            doc['deathIncrease'] = 0  # deathIncrease value did not exist or was NoneType, set it to 0
-
-                        try:
-                            var = doc['death'] > 0
-                            death = int(doc['death'])
-                        except:
-                            death = 0
-                        try:
-                            doc['deathPerCapita'] = death / int(rows['population']) * 10000
-                        except:
-                            doc['deathPerCapita'] = 0
-
-                        try:
-                            var = doc['hospitalizedCumulative']
-                            doc['hospitalizedPerCapita'] = int(doc['hospitalizedCumulative']) / int(rows['population']) * 10000
-                        except:
-                            doc['hospitalizedPerCapita'] = 0
-
-                        try:
-                            var = doc['inIcuCumulative']
-                            doc['icuPerCapita'] = int(doc['inIcuCumulative']) / int(rows['population']) * 10000
-                        except:
-                            doc['icuPerCapita'] = 0
-
-                        try:
-                            var = doc['positive']
-                            try:
-                                var = death > 0
-                                var = int(doc['positive']) > 0
-                                doc['mortalityRate'] = round(death / int(doc['positive']), 3) * 100
-                                doc['survivalRate'] = round(100 - int(doc['mortalityRate']), 3)
-                            except:
-                                doc['mortalityRate'] = 0
-                                doc['survivalRate'] = 0
-                        except Exception as mex:
-                            doc['mortalityRate'] = 0
-                            doc['survivalRate'] = 0
-                            print("mortalityRate Exception: ", mex)
-
-                        tmpAry.append(doc)  # capture newly constructed and current values
-
-                for tmpDoc in tmpAry:  # store newly constructed and current values in a new covidAry (for later rewrite of self.covidAry)
-                    covidNewAry.append(tmpDoc)
-                tmpAry.clear()
-
-        self.covidAry.clear()  # now that all the data in covidAry has been iterated, clear it for rewrite with newly constructed and current values
-        self.covidAry = covidNewAry  # rewrite self.covidAry with newly constructed and current values
-        print("length self.covidAry: ", len(self.covidAry))
-        self.doData(action='export', target='ES', fqp='currentCovid', frm='20200101')
-
-    def doLR(self, state):
-        pd.set_option('display.max_rows', None)
-        pd.set_option('display.max_columns', None)
-        covidDF = pd.read_json('data/export/currentCovid.json')
-        stateDF = covidDF.loc[covidDF['state'] == state]
-        print(stateDF)
-        xVals = pd.Series([num+1 for num in range(len(stateDF))])  # create enumerated Series representing each day for the x axis (1...number of days); add 1 to num so enumeration starts at 1
-        print("xVals.mean(): ", xVals.mean())
-
-        yVals = pd.Series(stateDF['deathIncrease'].values)  # transform yVals array to a Series so it can be added to lrDF dataframe (and so Series calculations can be done)
-        print("yVals.mean(): ", yVals.mean())
-
-        # create the linear reqression data frame (lrDF) and add the following columns
-        lrDF = pd.DataFrame()
-        lrDF['x'] = xVals
-        lrDF['y'] = yVals
-        lrDF['xDev'] = lrDF['x'] - xVals.mean()  # deviation of a point x from x mean value; x - x mean
-        lrDF['yDev'] = lrDF['y'] - yVals.mean()  # deviation of a point y from y mean value; y - y mean
-        lrDF['xDev2'] = lrDF['xDev'] * lrDF['xDev']  # deviation of x squared
-        lrDF['xDevXyDev'] = lrDF['xDev'] * lrDF['yDev']  # deviation of x times deviation of y (xDev * yDev)
-
-        slope = round(lrDF['xDevXyDev'].sum() / lrDF['xDev2'].sum(), 2)  # calculate the slope
-        print("slope: ", slope)
-        yIntercept = round(yVals.mean() - (slope * xVals.mean()), 2)  # calculate the  y intercept
-        print("yIntercept: ", yIntercept)
 
-        plt.plot(xVals, yVals, '.', label='Deaths Per Day')
-        plt.legend(loc="upper left")
-        plt.xlabel('Daily')
-        plt.ylabel('Death Count')
-        y_vals = yIntercept + slope * xVals
-        plt.plot(xVals, y_vals, '--')
-        plt.show()
-
-    def getDFData(self, df, rows, cols):
-        if not df:
-            df = pd.read_json('data/export/currentCovid.json')
-        print(df.iloc[self.getRowIndices(df, rows), self.getColIndices(df, cols)])
-        return df.iloc[self.getRowIndices(df, rows), self.getColIndices(df, cols)]
-
-    def getColIndices(self, df, cols):
-        dfCols = list(df.columns)
-        colIndices = []
-
-        if len(cols) == 0:  # no columns passed, get all column names
-            cols = list(df.columns)
-
-        for c in cols:  # find the valide numeric index of each column and add it to colIndices
-            try:
-                int(c)  # column passed as an integer, just add it to the list of indices (if integer in bounds)
-                if 0 <= c <= len(dfCols):  # ensure column number is not out of bounds
-                    colIndices.append(c)
-            except:
-                if c.find(":") > 0:
-                    rng = c.split(":")
-                    rngStart = int(rng[0])
-                    if rngStart < 0:
-                        rngStart = 0
-                    rngEnd = int(rng[1]) + 1
-                    if rngEnd > len(dfCols):
-                        rngEnd = len(dfCols)
-                    for col in range(rngStart, rngEnd):
-                        colIndices.append(col)
-                else:
-                    for col in dfCols:  # find the index number for these column names (column names passed as strings)
-                        if c == col:  # column names match, add this index to the list of indices
-                            colIndices.append(df.columns.get_loc(col))
-        return colIndices  # list of indexes
+        self.msg += "Exported " + str(numRecords) + " records to: " + os.path.abspath(self.fqp)
+
+    def getDocs(self, fromDate=0, after=False):  # documents dated fromDate or later (after=True: later only); the curated rows once curate has set covidDF, the feed records otherwise
+        fromDate = int(fromDate)
+        if self.covidDF is None:
+            return (doc.toDict() for doc in self.covidAry if doc.date > fromDate or (not after and doc.date == fromDate))
+        df = self.covidDF
+        dates = df['date'].dt.year * 10000 + df['date'].dt.month * 100 + df['date'].dt.day  # YYYYmmdd without formatting every row
+        return self.frameToDocs(df, (dates > fromDate) if after else (dates >= fromDate))  # dateTrack, per-capita and mortality fields included
+
+    def curate(self, incremental=False, updateIndex=False):  # incremental=True only enriches new/changed documents (needs a previous curate); updateIndex=True also upserts them into the index
+        manifest = self.loadManifest()
+        if not incremental or not manifest['hashes'] or not os.path.isdir(self.storePath):  # full curate
+            with metrics.stage('curate.frame'):
+                self.covidDF = self.getCuratedFrame()  # typed, columnar copy of covidAry with the derived columns added
+                metrics.count('curate.records', len(self.covidDF))
+            print("length self.covidDF: ", len(self.covidDF))
+            with metrics.stage('curate.export'):
+                self.exportFrame(self.covidDF, self.exportPath)
+            with metrics.stage('curate.store'):
+                self.storeFrame(self.covidDF, self.storePath)  # columnar copy partitioned by state (read by doLR/getDFData)
+            self.storeDF = self.covidDF
+            manifest = {'watermark': 0, 'hashes': {}}
+            changed = self.covidAry
+            changedDF = self.covidDF
+            replaced = []
+        else:
+            changed, replaced = self.getChangedDocs(manifest)
+            print("new/changed documents: ", len(changed), " (watermark " + str(manifest['watermark']) + ")")
+            if self.storeDF is None:  # first incremental run in this process: load the curated documents once
+                with metrics.stage('curate.load', incremental=True):
+                    self.storeDF = self.readCurated()
+            self.covidDF = self.storeDF  # export/insertLatest stream from covidDF
+            if not changed:
+                return
+            with metrics.stage('curate.frame', incremental=True):
+                changedDF = self.getCuratedFrame(changed)
+                metrics.count('curate.records', len(changedDF))
+            rewriteStates = {str(doc.state) for doc in changed if self.getManifestKey(doc) in manifest['hashes']}  # partitions holding rows being replaced
+            with metrics.stage('curate.store', incremental=True):
+                self.upsertFrame(changedDF, self.storePath, rewriteStates)
+            self.covidDF = self.storeDF = self.mergeFrame(self.storeDF, changedDF)
+
+        if updateIndex and len(changed) > 0:  # upsert the curated docs (partial update of existing ids) and drop superseded ids
+            self.esClient.bulkInsert(self.doc_type, self.frameToDocs(changedDF), opType='update')
+            if replaced:
+                self.esClient.bulkInsert(self.doc_type, [{'hash': h} for h in replaced], opType='delete')
+
+        entry = {'watermark': manifest['watermark'], 'hashes': {}}  # remember what has been curated
+        for doc in changed:
+            entry['hashes'][self.getManifestKey(doc)] = doc.hash
+            entry['watermark'] = max(entry['watermark'], doc.date)
+        self.saveManifest(entry, append=bool(manifest['hashes']))  # a full curate starts from an empty manifest and rewrites the file
+
+    def getManifestKey(self, doc):  # one record per state per day
+        return str(doc.state) + '|' + str(doc.date)
+
+    def getChangedDocs(self, manifest):  # documents that are new (state/date not curated yet) or changed upstream (different hash); plus the superseded hashes
+        changed = []
+        replaced = []
+        for doc in self.covidAry:
+            curatedHash = manifest['hashes'].get(self.getManifestKey(doc))
+            if curatedHash != doc.hash:
+                changed.append(doc)
+                if curatedHash is not None:
+                    replaced.append(curatedHash)
+        return changed, replaced
+
+    def loadManifest(self):  # {'watermark': highest curated date, 'hashes': {'NY|20200412': hash, ...}}; the file holds one json line per curate run, later lines win
+        manifest = {'watermark': 0, 'hashes': {}}
+        try:
+            with open(self.manifestFile) as manifestFile:
+                for line in manifestFile:
+                    entry = json.loads(line)
+                    manifest['watermark'] = max(manifest['watermark'], entry['watermark'])
+                    manifest['hashes'].update(entry['hashes'])
+        except (OSError, ValueError):  # missing or torn manifest: the next curate is a full one
+            return {'watermark': 0, 'hashes': {}}
+        return manifest
+
+    def saveManifest(self, manifest, append=False):  # append=True adds the changes of an incremental run as a new line instead of rewriting every hash
+        if append:
+            with open(self.manifestFile, 'a') as manifestFile:
+                manifestFile.write(json.dumps(manifest) + '\n')
+            return
+        with open(self.manifestFile + '.tmp', 'w') as manifestFile:
+            manifestFile.write(json.dumps(manifest) + '\n')  # dumps uses the C encoder; dump streams through the python one
+        os.replace(self.manifestFile + '.tmp', self.manifestFile)
+
+    def getCuratedFrame(self, docs=None):  # load covidAry (or the given records) into a typed DataFrame and compute the derived columns as vectorized expressions
+        import pandas as pd
+
+        population = self.loadPopulation()  # population table indexed by state digraph (loaded once)
+
+        df = pd.DataFrame(toColumns(self.covidAry if docs is None else fromDocs(docs)))  # columns straight from the records (nulls already real nulls)
+        for col in df.columns:
+            if col in self.countFields:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')  # nullable integer counts
+        df['date'] = pd.to_datetime(df['date'].astype(str), format='%Y%m%d')
+        df['state'] = df['state'].astype('category')
+
+        pop = df['state'].map(population).astype('float64')
+        df = df.loc[pop.notna()].reset_index(drop=True)  # keyed join: keep only documents with a matching state row
+        pop = pop.loc[pop.notna()].reset_index(drop=True)
+
+        df['dateTrack'] = df['date'].dt.strftime('%Y-%m-%d') + 'T12:00:00Z'
+        df['deathIncrease'] = self.getColumn(df, 'deathIncrease').fillna(0).clip(lower=0)  # at times states will publish a negative death increase to adjust for reporting errors; kibana throws a wobbly when this value is < 0
+
+        death = self.getColumn(df, 'death').fillna(0).astype('float64')
+        positive = self.getColumn(df, 'positive').astype('float64')
+        df['deathPerCapita'] = (death / pop * 10000).astype(self.rateDtype)
+        df['hospitalizedPerCapita'] = (self.getColumn(df, 'hospitalizedCumulative').astype('float64') / pop * 10000).fillna(0).astype(self.rateDtype)
+        df['icuPerCapita'] = (self.getColumn(df, 'inIcuCumulative').astype('float64') / pop * 10000).fillna(0).astype(self.rateDtype)
+
+        hasPositive = positive.notna() & (positive != 0)
+        mortalityRate = (self.roundColumn(death / positive.where(hasPositive), 3) * 100).fillna(0)
+        df['mortalityRate'] = mortalityRate.astype(self.rateDtype)
+        df['survivalRate'] = (100 - mortalityRate.astype('int64')).where(hasPositive, 0).astype('int64')
+        return df
+
+    def roundColumn(self, col, digits):  # vectorized round that agrees with python's round(); values sitting on a .5 boundary are re-rounded one at a time
+        rounded = col.round(digits)
+        scaled = col * 10 ** digits
+        onBoundary = ((scaled - scaled.round()).abs() - 0.5).abs() < 1e-6
+        if onBoundary.any():
+            rounded[onBoundary] = col[onBoundary].map(lambda v: round(v, digits))
+        return rounded
+
+    def getColumn(self, df, col):  # a nullable integer column from the frame; all nulls if the feed did not carry it
+        import pandas as pd
+
+        if col in df.columns:
+            return df[col]
+        return pd.Series(pd.NA, index=df.index, dtype='Int64')
+
+    def exportFrame(self, df, fqp):  # write a curated frame as a JSON array of documents (date back in YYYYmmdd form, nulls as null)
+        numRecords = exporters['ES'](fqp).write(self.frameToDocs(df))  # streamed, and floats keep every digit (to_json rounds to 10)
+        print("Exported " + str(numRecords) + " records to: " + os.path.abspath(fqp))  # own line; self.msg belongs to the current doData action
+
+    def storeFrame(self, df, path):  # write a curated frame as a parquet dataset partitioned by state (path/state=NY/...)
+        try:
+            import pyarrow  # parquet support is optional; without it analysis falls back to currentCovid.json
+        except ImportError:
+            print("pyarrow not installed; skipping parquet store")
+            return
+        if os.path.isdir(path):  # partitioned writes add files, clear the previous dataset first
+            shutil.rmtree(path)
+        out = df.copy()
+        out['state'] = out['state'].astype(str)
+        out.to_parquet(path, engine='pyarrow', partition_cols=['state'], index=False)
 
-    def getRowIndices(self, df, rows):
-        rowIndices = []
+    def upsertFrame(self, df, path, rewriteStates=()):  # add the rows of df to the parquet store as new files in the state partitions df touches; only the partitions in rewriteStates (rows being replaced) are read and rewritten
+        import pandas as pd
 
-        if len(rows) == 0:  # no rows passed, return all row indices
-            for row in df.iterrows():
-                rowIndices.append(row[0])
+        try:
+            import pyarrow
+            import pyarrow.dataset as ds
+        except ImportError:
+            print("pyarrow not installed; skipping parquet store")
+            return
+        if len(df) == 0:  # none of the changed documents has a population row; nothing to write
+            print("no curated records to upsert into ", path)
+            return
+        new = df.copy()
+        new['state'] = new['state'].astype(str)
+        frames = [new.loc[~new['state'].isin(rewriteStates)]]
+        rewritten = 0
+        for state, rows in new.loc[new['state'].isin(rewriteStates)].groupby('state', sort=True):
+            partition = os.path.join(path, 'state=' + state)
+            if os.path.isdir(partition):
+                current = pd.read_parquet(partition, engine='pyarrow')
+                current['state'] = state
+                keep = ~current['date'].isin(rows['date'])  # drop the rows being replaced (same state and date)
+                rows = pd.concat([current.loc[keep], rows], ignore_index=True).sort_values('date', ascending=False, kind='stable')
+                shutil.rmtree(partition)
+                rewritten += 1
+            frames.append(rows)
+        out = pd.concat(frames, ignore_index=True)
+        schema = self.getStoreSchema(path)  # appended files must match the existing ones (an all null column would otherwise be written as the null type)
+        if schema is not None:
+            schema = schema.append(pyarrow.field('state', pyarrow.string()))
+        table = pyarrow.Table.from_pandas(out, schema=schema, preserve_index=False)
+        ds.write_dataset(table, path, format='parquet', partitioning=['state'], partitioning_flavor='hive',
+                         basename_template=uuid.uuid4().hex + '-{i}.parquet', existing_data_behavior='overwrite_or_ignore')  # new files next to the existing ones
+        print("upserted ", len(new), " records into ", new['state'].nunique(), " state partitions of ", path, " (" + str(rewritten) + " rewritten)")
+
+    def getStoreSchema(self, path):  # arrow schema of the files in the parquet store (without the state partition column); None for an empty store
+        import pyarrow.parquet as pq
+
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                if name.endswith('.parquet'):
+                    return pq.read_schema(os.path.join(root, name))
+        return None
+
+    def mergeFrame(self, df, changedDF):  # covidDF with the rows of changedDF replacing/added to it (same state and date), newest first
+        import pandas as pd
+
+        new = changedDF.assign(state=changedDF['state'].astype(str))
+        keys = pd.MultiIndex.from_arrays([new['state'], new['date']])
+        keep = ~pd.MultiIndex.from_arrays([df['state'].astype(str), df['date']]).isin(keys)
+        merged = pd.concat([new, df.loc[keep].assign(state=df.loc[keep, 'state'].astype(str))], ignore_index=True)
+        if len(df) and new['date'].min() >= df['date'].max():  # the usual case: only newer days, already in order on top
+            return merged
+        return merged.sort_values('date', ascending=False, kind='stable').reset_index(drop=True)
+
+    def frameToDocs(self, df, mask=None):  # curated frame rows (those where the boolean Series mask is True) as documents (date back in YYYYmmdd form, nulls as None)
+        for start in range(0, len(df), self.docsChunkRows):  # converted a slice at a time, so memory stays bounded whatever the frame size
+            out = df.iloc[start:start + self.docsChunkRows]
+            if mask is not None:
+                out = out.loc[mask.iloc[start:start + self.docsChunkRows].to_numpy()]
+            out = out.assign(date=out['date'].dt.strftime('%Y%m%d').astype('int64'), state=out['state'].astype(str))
+            out = out.astype(object).where(out.notna(), None)
+            for doc in out.to_dict('records'):
+                yield doc
+
+    def readCurated(self, columns=None, states=None):  # read only the requested columns/state partitions of the curated data
+        import pandas as pd
+
+        if os.path.isdir(self.storePath):
+            readColumns = None
+            if columns is not None:
+                readColumns = list(dict.fromkeys(list(columns) + ['date']))  # keep date so rows can be returned in feed order
+            filters = None
+            if states is not None:
+                filters = [('state', 'in', list(states))]  # only the matching state=XX partitions are opened
+            df = pd.read_parquet(self.storePath, engine='pyarrow', columns=readColumns, filters=filters, memory_map=True)
+            if 'state' in df.columns:
+                df['state'] = df['state'].astype(str)
+                if columns is None:  # the partition column comes back last; put it back next to date (curated column order)
+                    df.insert(1, 'state', df.pop('state'))
+            df = df.sort_values('date', ascending=False, kind='stable').reset_index(drop=True)  # newest first, as in the feed
+            if columns is not None:
+                df = df[list(columns)]
+            return df
+
+        df = pd.read_json(self.exportPath)  # no parquet store yet, parse the json export
+        if states is not None:
+            df = df.loc[df['state'].isin(list(states))].reset_index(drop=True)
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    def loadPopulation(self):  # read the population table once and index it by state digraph: {'NY': 19453561, ...}
+        population = {}
+        with open('data/source/populationByState_2019.csv') as statePop:
+            for rows in csv.DictReader(statePop):
+                population[rows['digraph']] = self.toInt(rows['population'])
+        return population
+
+    def rollup(self, docs=None):  # write the summaries of the periods docs fall in (all periods when docs is None) to the <idx>-rollup index
+        esClient = ES_Client(self.idx + self.rollupSuffix)
+        if not esClient.checkIndex(esClient.idx):  # first rollup: summarize the full history, not just the new documents
+            self.esClient.createIndex(esClient.idx)  # mapping from the <idx> template (its <idx>-* pattern covers the companion index)
+            docs = None
+        rollupDocs = self.getRollups(docs)
+        with metrics.stage('rollup', incremental=docs is not None):
+            counts = esClient.bulkInsert(self.doc_type, rollupDocs, chunkSize=self.chunkSize)
+        return counts
+
+    def getRollups(self, docs=None):  # per-state weekly/monthly and national daily summary documents; docs limits them to the periods those records fall in
+        #   every summary document carries:
+        #       period          week (starting monday), month or day (national)
+        #       state           state digraph, US for the national summaries
+        #       date/dateTrack  first day of the period (YYYYmmdd / ISO date for kibana), dateEnd last reported day, days reported
+        #       rollupSums      summed over the period (plus per 10k population for deaths and cases)
+        #       rollupLatest    cumulative counts and rates as of the last reported day
+        #       hash            stable id (period|state|date), re-writing a period replaces its document
+        import pandas as pd
+
+        if self.covidDF is not None:  # already curated (insertLatest after curate, the daemon): nothing is re-curated
+            df = self.covidDF
+        elif docs is None:
+            df = self.getCuratedFrame()
+        else:  # curate only the records in the periods docs touch
+            df = self.getCuratedFrame(self.getRollupRecords(docs))
+        week = df['date'] - pd.to_timedelta(df['date'].dt.weekday, unit='D')
+        month = df['date'].dt.to_period('M').dt.start_time
+        population = self.loadPopulation()
+
+        if docs is None:
+            df = df.assign(week=week, month=month)
+            frames = [self.getStateRollup(df, 'week', population), self.getStateRollup(df, 'month', population), self.getNationalRollup(df, population.get('US'))]
+        else:  # only the state/periods and national days touched by docs
+            touched = pd.DataFrame({'state': [doc.state for doc in docs], 'date': pd.to_datetime([str(doc.date) for doc in docs], format='%Y%m%d')})
+            touched['week'] = touched['date'] - pd.to_timedelta(touched['date'].dt.weekday, unit='D')
+            touched['month'] = touched['date'].dt.to_period('M').dt.start_time
+            state = df['state'].astype(str)
+            frames = []
+            for period, periods in (('week', week), ('month', month)):
+                keys = pd.MultiIndex.from_frame(touched[['state', period]].astype({'state': str}))
+                mask = pd.MultiIndex.from_arrays([state, periods]).isin(keys)
+                frames.append(self.getStateRollup(df.loc[mask].assign(**{period: periods[mask]}), period, population))
+            frames.append(self.getNationalRollup(df.loc[df['date'].isin(set(touched['date']))], population.get('US')))
+        return [doc for frame in frames for doc in self.frameToDocs(frame)]
+
+    def getRollupRecords(self, docs):  # feed records that can fall in the state/week, state/month and national day periods of docs (a superset; getRollups selects the exact periods)
+        windows = {}  # state -> [(first, last)] YYYYmmdd ranges covering the week and the month of each touched day
+        days = set()
+        for doc in docs:
+            day = datetime.date(doc.date // 10000, doc.date // 100 % 100, doc.date % 100)
+            week = day - datetime.timedelta(days=day.weekday())
+            monthEnd = (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+            first = min(week, day.replace(day=1))
+            last = max(week + datetime.timedelta(days=6), monthEnd)
+            windows.setdefault(doc.state, set()).add((int(first.strftime('%Y%m%d')), int(last.strftime('%Y%m%d'))))
+            days.add(doc.date)
+        return [record for record in self.covidAry
+                if record.date in days or any(first <= record.date <= last for first, last in windows.get(record.state, ()))]
+
+    def getStateRollup(self, df, period, population):  # one row per state per week/month
+        df = df.sort_values('date')
+        df = df.assign(state=df['state'].astype(str))
+        groups = df.groupby(['state', period], sort=False)
+        out = groups[self.rollupSums].sum()
+        out = out.join(groups.tail(1).set_index(['state', period])[self.rollupLatest])  # the last reported day's row as is (last() would skip its nulls)
+        out['dateEnd'] = groups['date'].max().dt.strftime('%Y%m%d').astype('int64')
+        out['days'] = groups.size()
+        out = out.reset_index().rename(columns={period: 'date'})
+        pop = out['state'].map(population).astype('float64')
+        out['deathIncreasePerCapita'] = (out['deathIncrease'].astype('float64') / pop * 10000).fillna(0)
+        out['positiveIncreasePerCapita'] = (out['positiveIncrease'].astype('float64') / pop * 10000).fillna(0)
+        return self.finishRollup(out, period)
+
+    def getNationalRollup(self, df, usPopulation):  # one row per day summed over every state
+        groups = df.groupby('date')
+        out = groups[self.rollupSums + ['death', 'positive', 'hospitalizedCumulative', 'inIcuCumulative']].sum()
+        out['days'] = 1
+        out['states'] = groups.size()
+        out = out.reset_index()
+        out['state'] = 'US'
+        out['dateEnd'] = out['date'].dt.strftime('%Y%m%d').astype('int64')
+        death = out['death'].astype('float64')
+        positive = out['positive'].astype('float64')
+        out['deathPerCapita'] = death / usPopulation * 10000
+        out['hospitalizedPerCapita'] = out['hospitalizedCumulative'].astype('float64') / usPopulation * 10000
+        out['icuPerCapita'] = out['inIcuCumulative'].astype('float64') / usPopulation * 10000
+        out['deathIncreasePerCapita'] = out['deathIncrease'].astype('float64') / usPopulation * 10000
+        out['positiveIncreasePerCapita'] = out['positiveIncrease'].astype('float64') / usPopulation * 10000
+        out['mortalityRate'] = (self.roundColumn(death / positive.where(positive > 0), 3) * 100).fillna(0)
+        return self.finishRollup(out, 'day')
+
+    def finishRollup(self, out, period):  # period/dateTrack/hash columns shared by every summary document
+        out['period'] = period
+        out['dateTrack'] = out['date'].dt.strftime('%Y-%m-%d') + 'T12:00:00Z'
+        out['hash'] = period + '|' + out['state'] + '|' + out['date'].dt.strftime('%Y%m%d')
+        return out
+
+    def toInt(self, value):  # int value of a feed field; None when the field is missing, None or the "None" string
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def doLR(self, state, plotDir=None):  # least squares trend of a single state's deathIncrease; plotDir='directory' renders the plot to a png file
+        trend = self.getTrends(states=[state], plotDir=plotDir)
+        if len(trend) == 0:
+            print("no data for state: ", state)
+            return None
+        row = trend.iloc[0]
+        print("xVals.mean(): ", row['xMean'])
+        print("yVals.mean(): ", row['yMean'])
+        slope = round(row['slope'], 2)  # calculate the slope
+        print("slope: ", slope)
+        yIntercept = round(row['yMean'] - (slope * row['xMean']), 2)  # calculate the  y intercept
+        print("yIntercept: ", yIntercept)
+        return trend
+
+    def getTrends(self, field='deathIncrease', states=None, window=None, weights=None, plotDir=None):  # least squares slope/intercept of field against day number (1...n, oldest first) for every state at once
+        # window='Optional: fit only the most recent n days', weights='Optional: None or "linear" (recent days weigh more)', plotDir='Optional: render one png per state into this directory'
+        import numpy as np
+        import pandas as pd
+
+        df = self.readCurated(columns=['date', 'state', field], states=states)
+        df = df.loc[df[field].notna()].sort_values(['state', 'date'], kind='stable').reset_index(drop=True)
+
+        stateCodes, stateNames = pd.factorize(df['state'], sort=True)  # grouped arrays: one integer code per state
+        y = df[field].to_numpy(dtype='float64')
+        x = df.groupby(stateCodes).cumcount().to_numpy(dtype='float64') + 1  # day number within each state
+        n = np.bincount(stateCodes, minlength=len(stateNames)).astype('float64')
+
+        w = np.ones_like(y)
+        if window is not None:  # drop everything older than the last 'window' days of each state
+            w[x <= n[stateCodes] - window] = 0
+        if weights == 'linear':
+            w = w * x
+
+        def groupSum(values):
+            return np.bincount(stateCodes, weights=values, minlength=len(stateNames))
+
+        sw, sx, sy = groupSum(w), groupSum(w * x), groupSum(w * y)
+        sxx, sxy = groupSum(w * x * x), groupSum(w * x * y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xMean = sx / sw
+            yMean = sy / sw
+            slope = (sxy - sx * yMean) / (sxx - sx * xMean)  # sum of w*xDev*yDev / sum of w*xDev^2
+        yIntercept = yMean - slope * xMean
+
+        trend = pd.DataFrame({'state': np.asarray(stateNames), 'n': n.astype('int64'), 'xMean': xMean, 'yMean': yMean, 'slope': slope, 'yIntercept': yIntercept})
+        if plotDir:
+            self.plotTrends(df, x, trend, field, plotDir)
+        return trend
+
+    def getRollingTrends(self, field='deathIncrease', window=14, states=None):  # slope of field over a trailing window of days, for every state and day; vectorized with per state cumulative sums
+        import numpy as np
+        import pandas as pd
+
+        df = self.readCurated(columns=['date', 'state', field], states=states)
+        df = df.loc[df[field].notna()].sort_values(['state', 'date'], kind='stable').reset_index(drop=True)
+        stateCodes = pd.factorize(df['state'], sort=True)[0]
+        y = df[field].to_numpy(dtype='float64')
+        x = df.groupby(stateCodes).cumcount().to_numpy(dtype='float64') + 1
+
+        def windowSum(values):  # sum of values over the trailing window within each state
+            cs = np.concatenate(([0.0], np.cumsum(values)))
+            idx = np.arange(len(values))
+            lag = np.maximum(idx + 1 - window, idx + 1 - x.astype('int64'))  # never reach back into the previous state
+            return cs[idx + 1] - cs[lag]
+
+        cnt, sx, sy = windowSum(np.ones_like(y)), windowSum(x), windowSum(y)
+        sxx, sxy = windowSum(x * x), windowSum(x * y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (cnt * sxy - sx * sy) / (cnt * sxx - sx * sx)
+        slope[cnt < window] = np.nan  # not enough history yet
+        return pd.DataFrame({'state': df['state'].to_numpy(), 'date': df['date'].to_numpy(), 'slope': slope})
+
+    def plotTrends(self, df, x, trend, field, plotDir):  # one png per state (headless Agg backend)
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        os.makedirs(plotDir, exist_ok=True)
+        for row in trend.itertuples():
+            mask = (df['state'] == row.state).to_numpy()
+            xVals = x[mask]
+            fig, ax = plt.subplots()
+            ax.plot(xVals, df[field].to_numpy()[mask], '.', label='Deaths Per Day' if field == 'deathIncrease' else field)
+            ax.plot(xVals, row.yIntercept + row.slope * xVals, '--')
+            ax.legend(loc="upper left")
+            ax.set_xlabel('Daily')
+            ax.set_ylabel('Death Count' if field == 'deathIncrease' else field)
+            fig.savefig(os.path.join(plotDir, row.state + '_' + field + '.png'))
+            plt.close(fig)
+
+    def getDFData(self, df, rows, cols):  # rows/cols: arrays of selectors; see getSelector()
+        import pandas as pd
+
+        if not isinstance(df, pd.DataFrame):
+            df = self.readCurated()
+        result = df.iloc[self.getRowIndices(df, rows), self.getColIndices(df, cols)]  # selectors compiled once, one iloc call
+        print(result)
+        return result
+
+    def getColIndices(self, df, cols):  # compiled column selector (slice or array of positions)
+        return self.getSelector(df, cols, axis=1)
+
+    def getRowIndices(self, df, rows):  # compiled row selector (slice, array of positions or boolean mask)
+        return self.getSelector(df, rows, axis=0)
+
+    def getSelector(self, df, items, axis=0):  # compile a selector list into something iloc accepts without touching rows one at a time
+        #   items (any mix):
+        #       5, -1           position (negative counts from the end); out of bounds positions are ignored
+        #       '0:50', '-7:'   inclusive position range, either end optional, clamped to bounds
+        #       'NY', 'death'   row index label / column name
+        #       'state==NY'     predicate on a column (==, !=, >=, <=, >, <); rows only; predicates are ANDed and filter the positions selected
+        #   no items selects everything
+        import numpy as np
+
+        size = df.shape[axis]
+        labels = df.index if axis == 0 else df.columns
+        ranges = []
+        positions = []
+        mask = None
+
+        for item in items:
+            if isinstance(item, (int, np.integer)):
+                if -size <= item < size:
+                    positions.append(np.array([item % size]))
+                continue
+
+            item = str(item).strip()
+            predicate = re.match(r'^(\w+)\s*(==|!=|>=|<=|>|<)\s*(.+)$', item) if axis == 0 else None
+            if predicate:
+                itemMask = self.getPredicateMask(df, *predicate.groups())
+                mask = itemMask if mask is None else mask & itemMask
+            elif re.match(r'^-?\d*:-?\d*$', item):
+                start, end = item.split(':')
+                start = int(start) if start else 0
+                end = int(end) if end else size - 1
+                if start < 0:
+                    start += size
+                if end < 0:
+                    end += size
+                ranges.append(slice(max(start, 0), min(end, size - 1) + 1))  # range end is inclusive
+            elif re.match(r'^-?\d+$', item):
+                pos = int(item)
+                if -size <= pos < size:
+                    positions.append(np.array([pos % size]))
+            else:
+                found = labels.get_indexer([item])
+                positions.append(found[found >= 0])
+
+        if not ranges and not positions:  # only predicates (or nothing): a mask or everything
+            if mask is None:
+                return slice(None)
+            return mask.to_numpy(dtype=bool, na_value=False)
+        if len(ranges) == 1 and not positions and mask is None:  # a single range stays a slice
+            return ranges[0]
+
+        selected = np.concatenate([np.arange(size)[r] for r in ranges] + positions).astype('int64')
+        if mask is not None:
+            selected = selected[mask.to_numpy(dtype=bool, na_value=False)[selected]]
+        return selected
+
+    def getPredicateMask(self, df, col, op, value):  # boolean Series for "col op value"
+        import pandas as pd
+
+        column = df[col]
+        value = value.strip().strip('"').strip("'")
+        if pd.api.types.is_datetime64_any_dtype(column):
+            value = pd.to_datetime(value, format='%Y%m%d' if value.isdigit() else None)
+        elif pd.api.types.is_numeric_dtype(column):
+            value = float(value)
+        ops = {'==': column.eq, '!=': column.ne, '>=': column.ge, '<=': column.le, '>': column.gt, '<': column.lt}
+        return ops[op](value)
+
+    def search(self, sql=None, params=None, where=None, columns=None, orderBy=None, limit=None, iterator=False):  # local SQL over the curated data (see app/localsql.py); returns a DataFrame, or an iterator of dictionaries when iterator=True
+        #   sql='select ... from covid ...' (params for its ? placeholders), or the filter DSL:
+        #       where=['state==NY', 'date>=20200401'] (getSelector predicate syntax), columns=[...], orderBy='deathIncrease desc', limit=10
+        #   the DSL filter is also stored as the atHocQuery elasticsearch body, so the same question can be asked of the index
+        #   (doData(action='query', q='atHocQuery'))
+        if sql is None:
+            sql, params = toSQL(where, columns, orderBy, limit)
+            self.esClient.queries['atHocQuery'] = toESQuery(where)
+            needed, states = getNeeded(where, columns, orderBy)
         else:
-            for row in rows:
-                try:
-                    int(row)
-                    if 0 <= row <= len(df)-1:
-                        rowIndices.append(row)
-                except:
-                    if row.find(":") > 0:
-                        rng = row.split(":")
-                        rngStart = int(rng[0])
-                        if rngStart < 0:
-                            rngStart = 0
-                        rngEnd = int(rng[1])+1
-                        if rngEnd > len(df):
-                            rngEnd = len(df)
-                        for r in range(rngStart, rngEnd):
-                            rowIndices.append(r)
-                    else:
-                        rowIndices.append(int(row))
-        return rowIndices
-
-    def search(self):
-        self.esClient.queries['atHocQuery'] = "set me up!"
-        print(self.esClient.queries['atHocQuery'])
\ No newline at end of file
+            needed, states = None, None
+        localSQL = LocalSQL(self.storePath, self.readCurated, engine=self.sqlEngine)
+        with metrics.stage('search', engine=localSQL.engine):
+            return localSQL.query(sql, params, iterator=iterator, columns=needed, states=states)
\ No newline at end of file
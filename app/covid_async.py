@@ -0,0 +1,87 @@
+import asyncio
+
+from app.covid import Covid
+from app.dao.ES_AsyncClient import ES_AsyncClient
+from app.dao.Feed_Client import Feed_Client
+
+
+# Function: asyncio driver for Covid actions; runs several actions and/or indices at once under a concurrency limit
+#   AsyncCovid
+#       same actions and keyword arguments as Covid.doData (validated by Covid.setKwargs) but awaitable and backed by ES_AsyncClient
+#       supported actions: insertLatest, deleteIndex, deleteDoc, deleteDocs, query, checkIndex, export
+#   run(jobs, limit)
+#       jobs: array of (index, kwargs) tuples; each job gets its own AsyncCovid, all jobs share one pooled connection and one
+#       download of the feed; at most 'limit' jobs run at the same time; returns one result (or exception) per job, in order
+#
+#   Use Case:
+#       results = asyncio.run(run([('covid-19', {'action': 'insertLatest', 'doc_type': '_doc'}),
+#                                  ('covid-19-sources', {'action': 'checkIndex'}),
+#                                  ('covid-19', {'action': 'query', 'q': 'getMinDate', 'return_size': 1})], limit=4))
+
+class AsyncCovid(Covid):
+    def __init__(self, idx, es=None, feed=None, covidAry=None, **kwargs):  # kwargs passed to Feed_Client when no feed is given
+        self.idx = idx
+        self.esClient = ES_AsyncClient(self.idx, es=es)
+        self.feed = feed or Feed_Client(**kwargs)
+        self._covidAry = covidAry
+
+    async def getCovidAry(self):  # load the feed off the event loop (file/network io)
+        if self._covidAry is None:
+            self._covidAry = await asyncio.to_thread(self.feed.load)
+        return self._covidAry
+
+    async def doData(self, **kwargs):  # execute requested action
+        self.msg = ""
+        if kwargs.get('action') == 'checkIndex':
+            return await self.esClient.checkIndex(self.idx)
+        if not self.setKwargs(**kwargs):
+            print(self.msg)
+            return
+
+        if self.action == "insertLatest":
+            await self.getCovidAry()  # load off the event loop before getDocs reads covidAry
+            if await self.esClient.checkIndex(self.idx):
+                maxDate = (await self.esClient.summary('date', ['max']))['max']
+                if maxDate is not None:
+                    self.startDate = str(int(maxDate))
+            startDate = int(self.startDate)
+            dataset = self.getDocs(startDate, after=True)  # dictionaries built as each chunk is sent (curated rows once curate has run)
+            await self.esClient.createIndex()  # explicit mapping from config/covid-template.json (no-op if the index exists), like the sync insertLatest
+            return await self.esClient.insert(self.doc_type, dataset, chunkSize=self.chunkSize)
+
+        elif self.action == "deleteIndex":
+            await self.esClient.deleteIndex()
+
+        elif self.action == "deleteDoc":
+            await self.esClient.deleteDoc(self.doc_id)
+
+        elif self.action == "deleteDocs":
+            return await self.esClient.deleteRange(self.frm, self.to, slices=self.slices)
+
+        elif self.action == "query":
+            return [doc async for doc in self.esClient.query(q=self.q, return_size=self.return_size)]
+
+        elif self.action == "export":
+            await self.getCovidAry()
+            await asyncio.to_thread(self.export)
+
+        print(self.msg)
+
+
+async def run(jobs, limit=4, **kwargs):  # kwargs passed to Feed_Client (offline, ttl, ...)
+    es = ES_AsyncClient.getClient()  # one pooled connection shared by every job
+    feed = Feed_Client(**kwargs)
+    covidAry = None
+    if any(job[1].get('action') in ('insertLatest', 'export') for job in jobs):  # download/parse the feed once for all jobs that need it
+        covidAry = await asyncio.to_thread(feed.load)
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def runJob(idx, jobKwargs):
+        async with semaphore:
+            return await AsyncCovid(idx, es=es, feed=feed, covidAry=covidAry).doData(**jobKwargs)
+
+    try:
+        return await asyncio.gather(*(runJob(idx, jobKwargs) for idx, jobKwargs in jobs), return_exceptions=True)
+    finally:
+        await es.close()
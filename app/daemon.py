@@ -0,0 +1,212 @@
+import time
+import signal
+import threading
+
+from app.covid import Covid
+from app.metrics import metrics
+
+
+# Function: long running scheduler (python -m app daemon) that keeps one Covid instance warm between runs
+#   One process holds the pooled elasticsearch connection, the decoded feed (Feed_Client keeps it in memory and revalidates with
+#   ETag/Last-Modified) and a state|date -> hash map of what has been indexed, so a steady state cycle only costs the new data:
+#       curate      incremental curate (only new/changed records are enriched and upserted into the parquet store)
+#       ingest      indexes the curated rows (dateTrack, per-capita and rate fields), so it curates first when the curate job has
+#                   not seen the current feed yet. The first run is a regular insertLatest (one high-water mark query); later
+#                   runs diff the records against the in-memory hash map (Covid.getChangedDocs) and index only the curated rows
+#                   of new/changed records (superseded ids are deleted) and refresh the rollups they touch; no max(date) query.
+#                   The hash map only moves forward when every document was acknowledged: a run with failed documents raises
+#                   (counted as failed, retried next tick) and the retry re-sends the same diff
+#       export      re-write the exports in exportTargets
+#   every job first reloads the feed (free while it is unchanged) and is skipped when the data has not changed since its last run
+#
+#   Scheduling:
+#       schedule must name at least one job, each with a positive interval (ValueError otherwise)
+#       jobs run one at a time in a fixed order (curate, ingest, export) whenever they are due
+#       overlapping runs coalesce: a job that overran its interval (or was triggered several times while running) runs once, not
+#       once per missed tick; trigger(name) asks for an immediate run
+#       stop() (or SIGTERM/SIGINT under run()) lets the running job finish and then exits the loop
+#       clock is pluggable: Clock (monotonic time, interruptible sleep) or FakeClock (sleep advances the time instantly), so a
+#       schedule can be run deterministically against local stubs: Covid_Daemon('covid-19', clock=FakeClock(), offline=True).run(cycles=5)
+#
+#   Use Case:
+#       Covid_Daemon('covid-19', schedule={'ingest': 900, 'curate': 3600, 'export': 86400}, exportTargets=['CSV', 'BULK']).run()
+
+class Clock:  # real time
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds, wakeup):  # returns early when wakeup (a threading.Event) is set
+        wakeup.wait(max(seconds, 0))
+
+
+class FakeClock:  # deterministic time for tests; sleeping just moves the time forward
+    def __init__(self, start=0.0):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds, wakeup):
+        self.current += max(seconds, 0)
+
+    def advance(self, seconds):
+        self.current += seconds
+
+
+class Covid_Daemon:
+    schedule = {'ingest': 3600, 'curate': 3600, 'export': 86400}  # seconds between runs of each job (leave a job out to disable it)
+    jobOrder = ['curate', 'ingest', 'export']  # ingest and export read the curated rows
+    exportTargets = ['CSV']  # written to data/export/current<target extension>
+    exportDir = 'data/export/'
+
+    def __init__(self, idx, schedule=None, exportTargets=None, clock=None, covid=None, **kwargs):  # kwargs passed to Covid/Feed_Client (offline, ttl, url, ...)
+        kwargs.setdefault('ttl', 0)  # every ingest revalidates with the server (a 304 costs one request and no parsing)
+        self.covid = covid or Covid(idx, **kwargs)
+        self.schedule = dict(self.schedule if schedule is None else schedule)
+        if not self.schedule:
+            raise ValueError("no jobs scheduled; schedule at least one of " + ", ".join(self.jobOrder))
+        for name, seconds in self.schedule.items():
+            if name not in self.jobOrder:
+                raise ValueError("unknown job " + name + "; options: [" + ", ".join(self.jobOrder) + "]")
+            if not seconds > 0:
+                raise ValueError(name + " interval must be a positive number of seconds, got " + str(seconds))
+        self.exportTargets = list(exportTargets or self.exportTargets)
+        self.clock = clock or Clock()
+        self.wakeup = threading.Event()  # set by trigger() and stop() to cut a sleep short
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.nextRun = {name: self.clock.now() for name in self.jobOrder if name in self.schedule}  # every job runs on start
+        self.triggered = set()  # jobs asked to run again while they were running
+        self.indexed = None  # state|date -> hash of what is in the index (None until the first ingest)
+        self.covidAry = None  # feed array last loaded (the same object comes back while the feed is unchanged)
+        self.version = 0  # bumped whenever the feed changes
+        self.doneVersion = {name: 0 for name in self.jobOrder}  # feed version each job last processed
+        self.counts = {'runs': 0, 'skipped': 0, 'coalesced': 0, 'failed': 0, 'newRecords': 0}
+
+    def run(self, cycles=None):  # run due jobs until stop() (or for a number of scheduler cycles)
+        handlers = self.setSignals()
+        try:
+            cycle = 0
+            while not self.stopping and (cycles is None or cycle < cycles):
+                cycle += 1
+                for name in self.getDueJobs():
+                    if self.stopping:
+                        break
+                    self.runJob(name)
+                if not self.stopping:
+                    self.wakeup.clear()
+                    self.clock.sleep(min(self.nextRun.values()) - self.clock.now(), self.wakeup)
+        finally:
+            self.restoreSignals(handlers)
+        print("daemon stopped: ", self.counts)
+        return self.counts
+
+    def getDueJobs(self):
+        now = self.clock.now()
+        with self.lock:
+            return [name for name in self.jobOrder if name in self.nextRun and self.nextRun[name] <= now]
+
+    def runJob(self, name):
+        with self.lock:
+            due = self.nextRun[name]
+            self.triggered.discard(name)
+        try:
+            with metrics.stage('daemon.' + name):
+                self.refresh()
+                ran = self.doneVersion[name] != self.version
+                if ran:
+                    getattr(self, name)()
+                    self.doneVersion[name] = self.version
+            self.counts['runs' if ran else 'skipped'] += 1
+        except Exception as ex:  # keep the daemon alive; the job is retried on its next tick
+            self.counts['failed'] += 1
+            print(name + " failed: ", ex)
+
+        now = self.clock.now()
+        interval = self.schedule[name]
+        with self.lock:
+            if name in self.triggered:  # triggered (any number of times) while running: one immediate rerun
+                self.triggered.discard(name)
+                self.nextRun[name] = now
+                return
+            nextRun = due + interval
+            if nextRun <= now:  # overran one or more ticks: they collapse into a single run right away
+                missed = int((now - due) // interval)
+                self.counts['coalesced'] += missed - 1
+                nextRun = now
+            self.nextRun[name] = nextRun
+
+    def trigger(self, name='ingest'):  # run a job as soon as possible (several triggers before it starts are one run)
+        with self.lock:
+            self.nextRun[name] = self.clock.now()
+            self.triggered.add(name)
+        self.wakeup.set()
+
+    def stop(self, *args):  # finish the running job, then leave run()
+        self.stopping = True
+        self.wakeup.set()
+
+    def refresh(self):  # reload the feed; a new version when it changed
+        covidAry = self.covid.feed.load()
+        if covidAry is not self.covidAry:  # Feed_Client hands back the same array while the feed is unchanged
+            self.covidAry = covidAry
+            self.covid.covidAry = covidAry
+            self.version += 1
+
+    def ingest(self):
+        covid = self.covid
+        covidAry = self.covidAry
+        if self.doneVersion['curate'] != self.version:  # index curated rows only (curate is not scheduled, or has not run on this feed yet)
+            self.curate()
+            self.doneVersion['curate'] = self.version
+        failed = 0
+        if self.indexed is None:  # first run: regular insertLatest (creates the index, finds the high-water mark once)
+            counts = covid.doData(action='insertLatest', doc_type=covid.doc_type, chunkSize=covid.chunkSize, threads=covid.threads)
+            changed = covidAry
+            if counts is None:
+                raise RuntimeError("insertLatest did not run")
+            failed = counts['failed'] + counts.get('rollup', {}).get('failed', 0)
+            if failed:  # the high-water mark would skip what did not make it; from now on diff against nothing (re-send everything)
+                self.indexed = {}
+        else:
+            changed, replaced = covid.getChangedDocs({'hashes': self.indexed})  # same new/changed rule as incremental curate
+            if changed:
+                failed = covid.esClient.bulkInsert(covid.doc_type, self.getCuratedDocs(changed), chunkSize=covid.chunkSize, threads=covid.threads)['failed']
+                if replaced and not failed:  # an upstream revision gets a new hash (= new id); drop the document it replaces
+                    failed = covid.esClient.bulkInsert(covid.doc_type, [{'hash': h} for h in replaced], opType='delete')['failed']
+                if covid.rollups and not failed:
+                    failed = covid.rollup(changed)['failed']
+
+        if failed:  # keep the hash map as it was, so the next run sends the same changes again (ids are stable: re-sending is idempotent)
+            raise RuntimeError(str(failed) + " documents failed; " + str(len(changed)) + " new/changed records will be re-sent")
+        indexed = self.indexed or {}
+        for doc in changed:  # only the diff moves the hash map forward (the whole feed on the first run)
+            indexed[covid.getManifestKey(doc)] = doc.hash
+        self.indexed = indexed
+        metrics.count('daemon.newRecords', len(changed))
+        self.counts['newRecords'] += len(changed)
+        print("ingest: ", len(changed), " new/changed records")
+
+    def getCuratedDocs(self, changed):  # curated rows of the changed records, as insertLatest indexes them
+        import pandas as pd
+
+        df = self.covid.covidDF
+        dates = df['date'].dt.year * 10000 + df['date'].dt.month * 100 + df['date'].dt.day  # YYYYmmdd without formatting every row
+        keys = pd.MultiIndex.from_tuples([(str(doc.state), doc.date) for doc in changed])
+        return self.covid.frameToDocs(df, pd.Series(pd.MultiIndex.from_arrays([df['state'].astype(str), dates]).isin(keys), index=df.index))
+
+    def curate(self):
+        self.covid.curate(incremental=True)
+
+    def export(self):
+        for target in self.exportTargets:  # full history (Covid.startDate is the class default, not the index high-water mark)
+            self.covid.doData(action='export', target=target, fqp=self.exportDir + 'current' + target, frm=Covid.startDate)
+
+    def setSignals(self):  # SIGTERM/SIGINT stop gracefully (only possible from the main thread)
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+        return {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+    def restoreSignals(self, handlers):
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
@@ -0,0 +1,184 @@
+import json
+import asyncio
+from elasticsearch import AsyncElasticsearch, ElasticsearchException
+from elasticsearch.helpers import async_streaming_bulk
+from app.dao.ES_Client import ES_Client
+
+
+# Function: asyncio counterpart of ES_Client built on AsyncElasticsearch
+#   Clients can share one pooled AsyncElasticsearch connection (pass es=...), so several indices/actions can be
+#   driven concurrently from a single event loop (see app/covid_async.py)
+#   Specific Functions (all awaitable):
+#       checkIndex(index)
+#       putTemplate()              composable index template from ES_Client.templateFile (see ES_Client.putTemplate)
+#       createIndex(index)         put the template and create the index if it is missing (see ES_Client.createIndex)
+#       deleteIndex()              an alias (after a rebuild) is deleted through the versioned indices behind it
+#       getAliasIndices(alias)     concrete indices behind an alias ([] for a plain index)
+#       deleteDoc(doc_id)
+#       insert(doc_type, dataset)  _bulk insert; returns attempted/indexed/skipped/failed counts (same as ES_Client.bulkInsert)
+#       query(q=...)               async iterator over the hits of a named query (async for doc in client.query(q='getMaxDate'))
+#       deleteRange(frm, to)       single _delete_by_query on the date field; returns a deleted/total/failures summary
+#       summary(field, aggs)       size:0 metric aggregation (e.g. summary('date', ['max']))
+#       close()                    release the connection pool (only when this client created it)
+
+class ES_AsyncClient:
+    es = ""
+    queries = {}
+    idx = ""
+    scroll = '1m'
+    scrollSize = 1000  # hits per scroll round-trip
+    chunkSize = 500  # docs per _bulk request
+    maxChunkBytes = 10 * 1024 * 1024  # max size (bytes) of a single _bulk request (10MB)
+
+    def __init__(self, idx, es=None):
+        self.idx = idx
+        self.ownsClient = es is None
+        self.es = es or self.getClient()
+        self.config = ES_Client.getConfig()
+        self.queries = dict(ES_Client.defaultQueries)
+
+    @classmethod
+    def getClient(cls):  # one pooled connection configured like ES_Client (see ES_Client.getConfig); share it between clients for different indices
+        return AsyncElasticsearch(**ES_Client.getClientKwargs(ES_Client.getConfig()))
+
+    async def close(self):
+        if self.ownsClient:
+            await self.es.close()
+
+    async def checkIndex(self, index):
+        return await self.es.indices.exists(index=index)
+
+    async def putTemplate(self):  # see ES_Client.putTemplate
+        with open(ES_Client.templateFile) as templateFile:
+            template = json.load(templateFile)
+        await self.es.indices.put_index_template(name=self.idx, body={"index_patterns": [self.idx, self.idx + "-*"], "priority": 100, "template": template})
+
+    async def createIndex(self, index=None):  # see ES_Client.createIndex
+        index = index or self.idx
+        await self.putTemplate()
+        if not await self.checkIndex(index):
+            await self.es.indices.create(index=index)
+            print("The " + index + " index has been created")
+
+    async def deleteIndex(self):
+        msg = self.idx + " not found"
+        if await self.checkIndex(self.idx):
+            indices = await self.getAliasIndices() or [self.idx]  # an alias cannot be deleted by name; delete the indices behind it
+            await self.es.indices.delete(index=','.join(indices))
+            ES_Client.invalidateCache(self.idx)
+            msg = "The " + self.idx + " index has been deleted"
+        print(msg)
+
+    async def getAliasIndices(self, alias=None):  # see ES_Client.getAliasIndices
+        alias = alias or self.idx
+        if not await self.es.indices.exists_alias(name=alias):
+            return []
+        return list((await self.es.indices.get_alias(name=alias)).keys())
+
+    async def deleteDoc(self, doc_id):
+        try:
+            await self.es.delete(index=self.idx, id=doc_id)
+            ES_Client.invalidateCache(self.idx)
+        except ElasticsearchException as esx:
+            print("ElasticsearchException: ", esx)
+
+    async def insert(self, doc_type, dataset, **kwargs):  # kwargs: chunkSize, maxChunkBytes (see ES_Client.bulkInsert); docs rejected with 429 are re-sent with backoff like bulkInsert
+        counts = {'attempted': 0, 'indexed': 0, 'skipped': 0, 'failed': 0, 'reasons': {}}
+
+        def actions():
+            for doc in dataset:
+                counts['attempted'] += 1
+                if doc.get('hash') in (None, '', 'None'):
+                    counts['skipped'] += 1
+                    counts['reasons']['missing hash'] = counts['reasons'].get('missing hash', 0) + 1
+                    continue
+                yield {'_op_type': 'index', '_index': self.idx, '_type': doc_type, '_id': doc['hash'], '_source': doc}
+
+        try:
+            async for ok, item in async_streaming_bulk(self.es, actions(), chunk_size=int(kwargs.get('chunkSize', self.chunkSize)),
+                                                       max_chunk_bytes=int(kwargs.get('maxChunkBytes', self.maxChunkBytes)),
+                                                       max_retries=self.config['bulkMaxRetries'], initial_backoff=self.config['bulkInitialBackoff'],
+                                                       max_backoff=self.config['bulkMaxBackoff'], raise_on_error=False, raise_on_exception=False):
+                if ok:
+                    counts['indexed'] += 1
+                else:
+                    counts['failed'] += 1
+                    reason = ES_Client.getBulkErrorReason(item)
+                    counts['reasons'][reason] = counts['reasons'].get(reason, 0) + 1
+        except ElasticsearchException as esx:
+            counts['failed'] = counts['attempted'] - counts['indexed'] - counts['skipped']
+            counts['reasons'][type(esx).__name__] = counts['failed']
+            print("ElasticsearchException: ", esx)
+        ES_Client.invalidateCache(self.idx)
+
+        print(self.idx + ": records attempted: " + str(counts['attempted']) + ", imported: " + str(counts['indexed']) + ", skipped: " + str(counts['skipped']) + ", failed: " + str(counts['failed']))
+        return counts
+
+    async def query(self, **kwargs):  # kwargs: q='Required: query name found in self.queries', return_size='Optional: defaults to all', scrollSize='Optional: defaults to 1000'
+        return_size = kwargs.get('return_size', 'all')
+        body = self.queries[kwargs['q']]
+        if isinstance(body, str):
+            body = json.loads(body)
+
+        pageSize = int(kwargs.get('scrollSize', self.scrollSize))
+        if return_size != 'all':
+            pageSize = min(pageSize, int(return_size))
+            if pageSize <= 0:
+                return
+
+        returned = 0
+        sid = None
+        try:
+            qr = await self.es.search(index=self.idx, scroll=self.scroll, size=pageSize, body=body)
+            sid = qr.get('_scroll_id')
+            while len(qr['hits']['hits']) > 0:
+                for hit in qr['hits']['hits']:
+                    yield hit['_source']
+                    returned += 1
+                    if return_size != 'all' and returned >= int(return_size):
+                        return
+                qr = await self.es.scroll(scroll_id=sid, scroll=self.scroll)
+                sid = qr.get('_scroll_id', sid)
+        finally:
+            if sid:
+                try:
+                    await self.es.clear_scroll(scroll_id=sid)
+                except ElasticsearchException:
+                    pass  # scroll already expired
+
+    async def deleteRange(self, frm='', to='', **kwargs):  # kwargs: slices='Optional: defaults to "auto"', pollInterval='Optional: seconds between task checks: defaults to 1'
+        dateRange = {}
+        if str(frm) != '':
+            dateRange['gte'] = int(frm)
+        if str(to) != '':
+            dateRange['lte'] = int(to)
+        body = {"query": {"range": {"date": dateRange}}} if dateRange else {"query": {"match_all": {}}}
+
+        summary = {'deleted': 0, 'total': 0, 'failures': [], 'took': 0}
+        if not await self.checkIndex(self.idx):
+            print(self.idx + " not found")
+            return summary
+
+        try:  # always run as a task so the event loop is free while the cluster works
+            resp = await self.es.delete_by_query(index=self.idx, body=body, slices=kwargs.get('slices', 'auto'), conflicts='proceed', refresh=True, wait_for_completion=False)
+            while True:
+                task = await self.es.tasks.get(task_id=resp['task'])
+                if task.get('completed'):
+                    result = task.get('response', task['task']['status'])
+                    break
+                await asyncio.sleep(kwargs.get('pollInterval', 1))
+            summary['deleted'] = result.get('deleted', 0)
+            summary['total'] = result.get('total', 0)
+            summary['failures'] = result.get('failures', [])
+            summary['took'] = result.get('took', 0)
+        except ElasticsearchException as esx:
+            print("ElasticsearchException: ", esx)
+        ES_Client.invalidateCache(self.idx)
+
+        print(self.idx + ": records matched: " + str(summary['total']) + ", deleted: " + str(summary['deleted']) + ", failed: " + str(len(summary['failures'])))
+        return summary
+
+    async def summary(self, field, aggs=('min', 'max', 'count', 'sum'), query=None):  # see ES_Client.summary
+        body = {"size": 0, "query": query or {"match_all": {}}, "aggs": ES_Client.getMetricAggs(field, aggs)}
+        qr = await self.es.search(index=self.idx, body=body)
+        return ES_Client.getMetricValues(qr['aggregations'], aggs)
@@ -1,30 +1,68 @@
+import os
 import sys
-from elasticsearch import Elasticsearch, ElasticsearchException
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, ElasticsearchException, NotFoundError
+from elasticsearch.helpers import streaming_bulk
+from app.metrics import metrics
+from app.dao.Query_Cache import Query_Cache
 
 
 class ES_Client:
     es = ""
-    resultSet = []
+    sharedClient = None  # one pooled Elasticsearch client per process, shared by every ES_Client instance
+    sharedCache = None  # process wide query result cache (Query_Cache), created when queryCacheSize > 0
+    clientLock = threading.Lock()
+    configFile = os.environ.get('ES_CONFIG', 'config/elasticsearch.json')  # overrides for defaultConfig (json); path can be set with the ES_CONFIG environment variable
+    templateFile = 'config/covid-template.json'  # index settings and explicit mapping applied through putTemplate()
+    defaultConfig = {
+        "hosts": [{"host": "localhost", "port": 9200}],  # the ES_HOSTS environment variable (comma separated host:port) overrides this
+        "maxsize": 25,  # pooled connections per node
+        "timeout": 30,  # seconds per request
+        "retryOnTimeout": True,
+        "maxRetries": 5,  # transport level retries (next node/connection)
+        "retryOnStatus": [429, 502, 503, 504],
+        "sniffOnStart": False,
+        "sniffOnConnectionFail": False,
+        "snifferTimeout": None,  # seconds between sniffs (None disables periodic sniffing)
+        "httpCompress": True,
+        "bulkMaxRetries": 8,  # times a document rejected with 429 is re-sent during a _bulk load
+        "bulkInitialBackoff": 2,  # seconds before the first _bulk retry (doubles on each retry)
+        "bulkMaxBackoff": 60,  # max seconds between _bulk retries
+        "queryCacheSize": 0,  # cached query results kept by query() (least recently used evicted first); 0 disables the cache
+        "queryCacheTTL": 300,  # seconds a cached result is served
+        "queryCacheCheckInterval": 30,  # seconds between index generation checks (writes from other processes are noticed within this)
+        "queryCacheMaxDocs": 10000  # results with more docs than this are not cached
+    }
     queries = {}
     idx = ""
     q = ""
     scroll = '1m'
-    scrollSize = 10  # default scroll size to 10
+    scrollSize = 1000  # default page size (hits per scroll/search_after round-trip) to 1000
     return_size = "all"
+    chunkSize = 500  # default number of docs sent per _bulk request
+    maxChunkBytes = 10 * 1024 * 1024  # default max size (bytes) of a single _bulk request (10MB)
+    threads = 1  # default number of parallel _bulk workers (1 == serial streaming_bulk)
+    pollInterval = 1  # default seconds between task status checks (used in deleteRange when waitForCompletion=False)
 
-    # q = {"query":{"match_all": {}},"size": 0,"aggs": {"max_date": {"max": {"field": "date"}}}}
     # q = {"query": { "range": {"date": {"gt": 20200328}}}}
+    # min/max/count/sum style questions go through summary(), termsSummary() and histogramSummary() (size:0 aggregations, one round-trip)
+
+    defaultQueries = {  # named queries (copied onto each client as self.queries; shared with ES_AsyncClient)
+        "getMaxDate": '{"query": {"match_all": {}}, "sort": [{"date": {"order": "desc"}}], "_source": "date"}',
+
+        "getMinDate": '{"query": {"match_all": {}}, "sort": [{"date": {"order": "asc"}}], "_source": "date"}',
+
+        "atHocQuery": ''
+    }
 
     def __init__(self, idx):
         self.idx = idx
         self.getClient()
-        self.queries = {
-            "getMaxDate": '{"query": {"match_all": {}}, "sort": [{"date": {"order": "desc"}}], "_source": "date"}',
-
-            "getMinDate": '{"query": {"match_all": {}}, "sort": [{"date": {"order": "asc"}}], "_source": "date"}',
-
-            "atHocQuery": ''
-        }
+        self.queries = dict(self.defaultQueries)
 
     def getQueries(self):
         return self.queries
@@ -50,8 +88,70 @@ class ES_Client:
         except:
             pass  # use default value
 
-    def getClient(self):
-        self.es = Elasticsearch([{'host': 'localhost', 'port': '9200'}])
+    def getClient(self):  # reuse the process wide pooled client (created on first use from getConfig())
+        with ES_Client.clientLock:
+            if ES_Client.sharedClient is None:
+                ES_Client.sharedClient = Elasticsearch(**self.getClientKwargs(self.getConfig()))
+            self.config = self.getConfig()
+            if ES_Client.sharedCache is None and self.config['queryCacheSize'] > 0:
+                ES_Client.sharedCache = Query_Cache(self.config['queryCacheSize'], self.config['queryCacheTTL'], self.config['queryCacheCheckInterval'])
+        self.es = ES_Client.sharedClient
+
+    @classmethod
+    def getConfig(cls):  # defaultConfig overlaid with configFile (if it exists) and the ES_HOSTS environment variable
+        config = dict(cls.defaultConfig)
+        if os.path.exists(cls.configFile):
+            with open(cls.configFile) as configFile:
+                config.update(json.load(configFile))
+        if os.environ.get('ES_HOSTS'):
+            config['hosts'] = os.environ['ES_HOSTS'].split(',')
+        return config
+
+    @classmethod
+    def getClientKwargs(cls, config):  # map config names onto Elasticsearch/AsyncElasticsearch constructor arguments
+        return {
+            'hosts': config['hosts'],
+            'maxsize': config['maxsize'],
+            'timeout': config['timeout'],
+            'retry_on_timeout': config['retryOnTimeout'],
+            'max_retries': config['maxRetries'],
+            'retry_on_status': tuple(config['retryOnStatus']),
+            'sniff_on_start': config['sniffOnStart'],
+            'sniff_on_connection_fail': config['sniffOnConnectionFail'],
+            'sniffer_timeout': config['snifferTimeout'],
+            'http_compress': config['httpCompress'],
+        }
+
+    def putTemplate(self):  # composable index template (compact explicit mapping) for this index and its versioned/companion indices (<idx>-*)
+        with open(self.templateFile) as templateFile:
+            template = json.load(templateFile)
+        self.es.indices.put_index_template(name=self.idx, body={"index_patterns": [self.idx, self.idx + "-*"], "priority": 100, "template": template})
+
+    def createIndex(self, index=None):  # create the index explicitly (mapping comes from the template) instead of letting the first insert auto-create it
+        index = index or self.idx
+        self.putTemplate()
+        if not self.checkIndex(index):
+            self.es.indices.create(index=index)
+            print("The " + index + " index has been created")
+
+    def setBulkProfile(self, index=None):  # ingest optimized settings (no refresh, no replicas); returns the previous settings for restoreProfile()
+        index = index or self.idx
+        current = list(self.es.indices.get_settings(index=index, name=['index.refresh_interval', 'index.number_of_replicas'], include_defaults=True).values())[0]  # keyed by the concrete index name (index may be an alias)
+        saved = {}
+        for key in ('refresh_interval', 'number_of_replicas'):
+            saved[key] = current.get('settings', {}).get('index', {}).get(key, current.get('defaults', {}).get('index', {}).get(key))
+        self.es.indices.put_settings(index=index, body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+        return saved
+
+    def restoreProfile(self, saved, index=None):  # put back the settings saved by setBulkProfile() and make the loaded docs searchable
+        index = index or self.idx
+        self.es.indices.put_settings(index=index, body={"index": saved})
+        self.es.indices.refresh(index=index)
+
+    def getIndexStats(self, index=None):  # doc count and on-disk size of an index
+        index = index or self.idx
+        stats = self.es.indices.stats(index=index, metric='docs,store')['_all']['primaries']
+        return {'docs': stats['docs']['count'], 'sizeInBytes': stats['store']['size_in_bytes']}
 
     def checkIndex(self, index):
         return self.es.indices.exists(index=index)
@@ -59,11 +159,68 @@ class ES_Client:
     def deleteIndex(self):
         msg = self.idx + " not found"
         if self.checkIndex(self.idx):
-            self.es.indices.delete(index=self.idx)
+            indices = self.getAliasIndices() or [self.idx]  # an alias is deleted through the versioned indices behind it
+            self.es.indices.delete(index=','.join(indices))
+            self.invalidateCache(self.idx)
             msg = "The " + self.idx + " index has been deleted"
         print(msg)
 
+    def getAliasIndices(self, alias=None):  # concrete indices behind an alias; [] when the name is a plain index (or missing)
+        alias = alias or self.idx
+        if not self.es.indices.exists_alias(name=alias):
+            return []
+        return list(self.es.indices.get_alias(name=alias).keys())
+
+    def getVersionedIndex(self):  # new timestamped index name, e.g. covid-19-20200412093000
+        return self.idx + "-" + time.strftime('%Y%m%d%H%M%S')
+
+    def swapAlias(self, newIndex):  # atomically point the alias at newIndex, then drop whatever it pointed at before
+        oldIndices = self.getAliasIndices()
+        actions = [{"remove": {"index": old, "alias": self.idx}} for old in oldIndices]
+        if not oldIndices and self.es.indices.exists(index=self.idx):  # first rebuild: idx is still a plain index, replace it in the same request
+            actions.append({"remove_index": {"index": self.idx}})
+        actions.append({"add": {"index": newIndex, "alias": self.idx, "is_write_index": True}})
+        self.es.indices.update_aliases(body={"actions": actions})
+        self.invalidateCache(self.idx)
+        for old in oldIndices:
+            if old != newIndex:
+                self.es.indices.delete(index=old)
+        print("The " + self.idx + " alias now points to " + newIndex)
+
+    def rebuild(self, doc_type, dataset, **kwargs):  # kwargs passed to bulkInsert (chunkSize, threads, ...); bulk load a new versioned index with the bulk profile, then swap the alias to it
+        newIndex = self.getVersionedIndex()
+        self.createIndex(newIndex)
+        saved = self.setBulkProfile(newIndex)
+        try:
+            counts = self.bulkInsert(doc_type, dataset, index=newIndex, **kwargs)
+        finally:
+            self.restoreProfile(saved, newIndex)
+        if counts['failed'] > 0:  # leave the current index in place; the partial build is dropped
+            self.es.indices.delete(index=newIndex)
+            print("rebuild failed; " + self.idx + " left unchanged")
+            return counts
+        self.swapAlias(newIndex)
+        counts['index'] = newIndex
+        return counts
+
+    def reindex(self, slices='auto'):  # server side _reindex of the current data into a new versioned index (picks up the current template/mapping), then swap the alias
+        newIndex = self.getVersionedIndex()
+        self.createIndex(newIndex)
+        saved = self.setBulkProfile(newIndex)
+        try:
+            resp = self.es.reindex(body={"source": {"index": self.idx}, "dest": {"index": newIndex}}, slices=slices, wait_for_completion=True, request_timeout=3600)
+        finally:
+            self.restoreProfile(saved, newIndex)
+        if resp.get('failures'):
+            self.es.indices.delete(index=newIndex)
+            print("reindex failed; " + self.idx + " left unchanged: ", resp['failures'][:5])
+            return resp
+        self.swapAlias(newIndex)
+        print("records reindexed: " + str(resp.get('total', 0)) + " into " + newIndex)
+        return resp
+
     def insert(self, doc_type, dataset):
+        self.invalidateCache(self.idx)
         imported = 0
         failed = 0
         for doc in dataset:
@@ -79,39 +236,318 @@ class ES_Client:
         print("", end='\r')
         print("records attempted: " + str(len(dataset)) + "\n records imported: " + str(imported) + "\n   records failed: " + str(failed))
 
+    # bulkInsert function receives
+    def bulkInsert(self, doc_type, dataset, **kwargs):  # kwargs: chunkSize='Optional: docs per _bulk request: defaults to 500', maxChunkBytes='Optional: max bytes per _bulk request: defaults to 10MB', threads='Optional: number of parallel _bulk workers: defaults to 1', index='Optional: target index: defaults to self.idx', opType='Optional: index, update or delete: defaults to index'
+        index = kwargs.get('index', self.idx)
+        opType = kwargs.get('opType', 'index')  # index (replace), update (partial update, insert when missing) or delete
+        chunkSize = int(kwargs.get('chunkSize', self.chunkSize))
+        maxChunkBytes = int(kwargs.get('maxChunkBytes', self.maxChunkBytes))
+        threads = int(kwargs.get('threads', self.threads))
+
+        counts = {'attempted': 0, 'indexed': 0, 'skipped': 0, 'failed': 0, 'reasons': {}, 'seconds': 0, 'docsPerSec': 0}  # structured result returned to the caller
+        start = time.time()
+
+        def actions():  # generate one _bulk index action per document; docs without a hash cannot be given a stable id and are skipped
+            for doc in dataset:
+                counts['attempted'] += 1
+                if doc.get('hash') in (None, '', 'None'):
+                    counts['skipped'] += 1
+                    counts['reasons']['missing hash'] = counts['reasons'].get('missing hash', 0) + 1
+                    continue
+                if opType == 'update':
+                    yield {'_op_type': 'update', '_index': index, '_type': doc_type, '_id': doc['hash'], 'doc': doc, 'doc_as_upsert': True}
+                elif opType == 'delete':
+                    yield {'_op_type': 'delete', '_index': index, '_type': doc_type, '_id': doc['hash']}
+                else:
+                    yield {'_op_type': 'index', '_index': index, '_type': doc_type, '_id': doc['hash'], '_source': doc}
+
+        retry = {'max_retries': self.config['bulkMaxRetries'], 'initial_backoff': self.config['bulkInitialBackoff'], 'max_backoff': self.config['bulkMaxBackoff']}  # docs rejected with 429 (cluster back-pressure) are re-sent with exponential backoff
+        if threads > 1:  # fan chunks out over a pool of worker threads
+            results = self.parallelBulk(actions(), threads, chunkSize, maxChunkBytes, retry)
+        else:  # stream chunks serially over a single connection
+            results = streaming_bulk(self.es, actions(), chunk_size=chunkSize, max_chunk_bytes=maxChunkBytes, raise_on_error=False, raise_on_exception=False, **retry)
+
+        try:
+            with metrics.stage('index.bulk', index=index, opType=opType, threads=threads):
+                self.countBulkResults(results, counts)
+        except ElasticsearchException as esx:  # transport level failure; whatever was not acknowledged is counted as failed
+            counts['failed'] = counts['attempted'] - counts['indexed'] - counts['skipped']
+            counts['reasons'][type(esx).__name__] = counts['failed']
+            print("ElasticsearchException: ", esx)
+        self.invalidateCache(index)  # after the load, so nothing cached while it ran survives it
+        metrics.count('index.indexed', counts['indexed'])
+        metrics.count('index.failed', counts['failed'])
+
+        counts['seconds'] = round(time.time() - start, 3)
+        if counts['seconds'] > 0:
+            counts['docsPerSec'] = round(counts['indexed'] / counts['seconds'], 1)
+        print("records attempted: " + str(counts['attempted']) + "\n records imported: " + str(counts['indexed']) + "\n  records skipped: " + str(counts['skipped']) + "\n   records failed: " + str(counts['failed']) + "\n       docs/sec: " + str(counts['docsPerSec']))
+        for reason, num in counts['reasons'].items():
+            print("   " + reason + ": " + str(num))
+        return counts
+
+    def countBulkResults(self, results, counts):  # one (ok, item) tuple is returned per document sent
+        for ok, item in results:
+            if ok:
+                counts['indexed'] += 1
+            else:
+                counts['failed'] += 1
+                reason = self.getBulkErrorReason(item)
+                counts['reasons'][reason] = counts['reasons'].get(reason, 0) + 1
+
+    def parallelBulk(self, actions, threads, chunkSize, maxChunkBytes, retry):  # send chunks from a pool of threads (each chunk retried with backoff); keeps at most 2 chunks per thread in flight
+        def sendChunk(chunk):
+            return list(streaming_bulk(self.es, chunk, chunk_size=chunkSize, max_chunk_bytes=maxChunkBytes, raise_on_error=False, raise_on_exception=False, **retry))
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            inFlight = deque()
+            chunk = []
+            for action in actions:
+                chunk.append(action)
+                if len(chunk) >= chunkSize:
+                    inFlight.append(pool.submit(sendChunk, chunk))
+                    chunk = []
+                    if len(inFlight) >= threads * 2:  # wait for the oldest chunk before reading more documents
+                        for result in inFlight.popleft().result():
+                            yield result
+            if chunk:
+                inFlight.append(pool.submit(sendChunk, chunk))
+            while inFlight:
+                for result in inFlight.popleft().result():
+                    yield result
+
+    @staticmethod
+    def getBulkErrorReason(item):  # pull a short failure reason out of a single _bulk response item
+        for op in item.values():  # item is keyed by the op type, e.g. {'index': {...}}
+            error = op.get('error', op.get('status', 'unknown'))
+            if isinstance(error, dict):
+                return str(error.get('type', 'unknown'))
+            return str(error)
+        return 'unknown'
+
     def insertDoc(self, doc):
+        self.invalidateCache(self.idx)
         try:
             self.es.index(index=self.idx, doc_type='_doc', id=doc['hash'], body=doc)
         except ElasticsearchException as esx:
             print("ElasticsearchException: ", esx)
 
     def deleteDoc(self, doc_id):
+        self.invalidateCache(self.idx)
         try:
             self.es.delete(index=self.idx, id=doc_id)
         except ElasticsearchException as esx:
             print("ElasticsearchException: ", esx)
 
-    # query function receives
-    def query(self, **kwargs):  # kwargs: q='Required: query name found in self.queries', scroll='Optional: time allotted for incremented search/response: defaults to 1m' scroll_size='Optional: size of each scroll increment: defaults to 10', return_size='Optional: numeric size of records to return: defaults to all'
+    # deleteRange function receives
+    def deleteRange(self, frm='', to='', **kwargs):  # kwargs: slices='Optional: number of parallel slices or "auto": defaults to "auto"', waitForCompletion='Optional: False runs as a server side task and polls its progress: defaults to True', pollInterval='Optional: seconds between progress checks: defaults to 1'
+        slices = kwargs.get('slices', 'auto')
+        waitForCompletion = kwargs.get('waitForCompletion', True)
+        pollInterval = kwargs.get('pollInterval', self.pollInterval)
+
+        dateRange = {}
+        if str(frm) != '':
+            dateRange['gte'] = int(frm)
+        if str(to) != '':
+            dateRange['lte'] = int(to)
+        if dateRange:  # delete docs within the frm-to date range
+            body = {"query": {"range": {"date": dateRange}}}
+        else:  # no frm-to date range provided, delete all docs
+            body = {"query": {"match_all": {}}}
+
+        summary = {'deleted': 0, 'total': 0, 'failures': [], 'took': 0}
+        if not self.checkIndex(self.idx):
+            print(self.idx + " not found")
+            return summary
+
+        self.invalidateCache(self.idx)
+        try:
+            resp = self.es.delete_by_query(index=self.idx, body=body, slices=slices, conflicts='proceed', refresh=True, wait_for_completion=waitForCompletion)
+            if not waitForCompletion:  # running as a task on the cluster; poll the tasks api until it completes
+                task_id = resp['task']
+                while True:
+                    task = self.es.tasks.get(task_id=task_id)
+                    status = task['task']['status']
+                    sys.stdout.write("\rdeleting: %s of %s" % (status.get('deleted', 0), status.get('total', 0)))
+                    if task.get('completed'):
+                        resp = task.get('response', status)
+                        print("", end='\r')
+                        break
+                    time.sleep(pollInterval)
+
+            summary['deleted'] = resp.get('deleted', 0)
+            summary['total'] = resp.get('total', 0)
+            summary['failures'] = resp.get('failures', [])
+            summary['took'] = resp.get('took', 0)
+        except ElasticsearchException as esx:
+            print("ElasticsearchException: ", esx)
+
+        print("records matched: " + str(summary['total']) + "\n records deleted: " + str(summary['deleted']) + "\n records failed: " + str(len(summary['failures'])))
+        return summary
+
+    # summary function receives
+    def summary(self, field, aggs=('min', 'max', 'count', 'sum'), query=None):  # single size:0 aggregation round-trip; returns {metric: value} for a numeric field (e.g. summary('date', ['max']))
+        body = {"size": 0, "query": query or {"match_all": {}}, "aggs": self.getMetricAggs(field, aggs)}
+        qr = self.es.search(index=self.idx, body=body)
+        return self.getMetricValues(qr['aggregations'], aggs)
+
+    def termsSummary(self, field, aggs=('min', 'max', 'count', 'sum'), by='state', size=100, query=None):  # per bucket (e.g. per state) metrics; returns {bucketKey: {metric: value, 'docCount': n}}
+        body = {"size": 0, "query": query or {"match_all": {}},
+                "aggs": {"byTerm": {"terms": {"field": by, "size": size}, "aggs": self.getMetricAggs(field, aggs)}}}
+        qr = self.es.search(index=self.idx, body=body)
+        results = {}
+        for bucket in qr['aggregations']['byTerm']['buckets']:
+            results[bucket['key']] = self.getMetricValues(bucket, aggs)
+            results[bucket['key']]['docCount'] = bucket['doc_count']
+        return results
+
+    def histogramSummary(self, field, aggs=('sum',), dateField='dateTrack', interval='week', by=None, size=100, query=None):  # date_histogram rollup (day, week, month...); optionally split per term (by='state'); returns an array of dictionaries
+        histogram = {"date_histogram": {"field": dateField, "calendar_interval": interval}, "aggs": self.getMetricAggs(field, aggs)}
+        if by:
+            searchAggs = {"byTerm": {"terms": {"field": by, "size": size}, "aggs": {"byDate": histogram}}}
+        else:
+            searchAggs = {"byDate": histogram}
+        qr = self.es.search(index=self.idx, body={"size": 0, "query": query or {"match_all": {}}, "aggs": searchAggs})
+
+        results = []
+        if by:
+            termBuckets = qr['aggregations']['byTerm']['buckets']
+        else:
+            termBuckets = [qr['aggregations']]
+        for termBucket in termBuckets:
+            for bucket in termBucket['byDate']['buckets']:
+                row = {'date': bucket['key_as_string'], 'docCount': bucket['doc_count']}
+                if by:
+                    row[by] = termBucket['key']
+                row.update(self.getMetricValues(bucket, aggs))
+                results.append(row)
+        return results
+
+    @staticmethod
+    def getMetricAggs(field, aggs):  # build one metric aggregation per requested metric (count maps to value_count)
+        metricAggs = {}
+        for metric in aggs:
+            aggType = 'value_count' if metric == 'count' else metric
+            metricAggs[metric] = {aggType: {"field": field}}
+        return metricAggs
+
+    @staticmethod
+    def getMetricValues(aggregations, aggs):  # pull the metric values back out of an aggregation response
+        return {metric: aggregations[metric]['value'] for metric in aggs}
+
+    # iterQuery function receives
+    def iterQuery(self, **kwargs):  # kwargs: q='Required: query name found in self.queries', scroll='Optional: time allotted for incremented search/response: defaults to 1m' scrollSize='Optional: size of each page: defaults to 1000', return_size='Optional: numeric size of records to return: defaults to all', paging='Optional: "scroll" or "pit" (point in time + search_after): defaults to scroll'
         self.setKwargs(**kwargs)  # analyze kwargs and set as appropriate
+        return_size = self.return_size
+        if 'return_size' not in kwargs or str(kwargs['return_size']) == 'all':  # return_size applies to this call only
+            return_size = "all"
+        paging = kwargs.get('paging', 'scroll')
+
+        body = self.queries[self.q]
+        if isinstance(body, str):
+            body = json.loads(body)
+
+        pageSize = self.scrollSize
+        if return_size != "all":
+            pageSize = min(pageSize, int(return_size))  # never fetch more in a page than the caller asked for
+            if pageSize <= 0:
+                return
+
+        if paging == 'pit':
+            pages = self.pitPages(body, pageSize)
+        else:
+            pages = self.scrollPages(body, pageSize)
+
+        returned = 0
+        try:
+            for hits in pages:  # yield each hit as it arrives; stop paging as soon as return_size is reached
+                for hit in hits:
+                    yield hit['_source']
+                    returned += 1
+                    if return_size != "all" and returned >= int(return_size):
+                        return
+        finally:
+            pages.close()  # release the scroll context / point in time on exit (including early exit)
+
+    def scrollPages(self, body, pageSize):  # generate pages of hits using the scroll api; clears the scroll context on exit
+        sid = None
+        try:
+            qr = self.es.search(index=self.idx, scroll=self.scroll, size=pageSize, body=body)  # execute initial search and retrieve scroll_id
+            sid = qr.get('_scroll_id')
+            while len(qr['hits']['hits']) > 0:  # iterate/scroll the remainder of the query until an empty page is returned
+                yield qr['hits']['hits']
+                qr = self.es.scroll(scroll_id=sid, scroll=self.scroll)
+                sid = qr.get('_scroll_id', sid)  # Update the scroll ID
+        finally:
+            if sid:
+                try:
+                    self.es.clear_scroll(scroll_id=sid)
+                except ElasticsearchException:
+                    pass  # scroll already expired
+
+    def pitPages(self, body, pageSize):  # generate pages of hits using a point in time and search_after; closes the point in time on exit
+        pit_id = self.es.open_point_in_time(index=self.idx, keep_alive=self.scroll)['id']
+        body = dict(body)
+        body.setdefault('sort', [{"date": {"order": "asc"}}])  # search_after requires a sort; the pit adds the _shard_doc tiebreaker
+        body['size'] = pageSize
+        try:
+            while True:
+                body['pit'] = {"id": pit_id, "keep_alive": self.scroll}
+                qr = self.es.search(body=body)  # no index on a pit search, the pit carries it
+                pit_id = qr.get('pit_id', pit_id)
+                hits = qr['hits']['hits']
+                if len(hits) == 0:
+                    break
+                yield hits
+                body['search_after'] = hits[-1]['sort']
+        finally:
+            try:
+                self.es.close_point_in_time(body={"id": pit_id})
+            except ElasticsearchException:
+                pass  # point in time already expired
+
+    # query function receives
+    def query(self, **kwargs):  # kwargs: same as iterQuery plus cache='Optional: False bypasses the query cache: defaults to True'; returns an array of dictionaries containing _source data
+        cache = ES_Client.sharedCache
+        if cache is None or not kwargs.get('cache', True):
+            return list(self.iterQuery(**kwargs))
+
+        body = self.queries[kwargs['q']]
+        key = (self.idx, body if isinstance(body, str) else json.dumps(body, sort_keys=True), str(kwargs.get('return_size', 'all')))
+        generation = cache.getGeneration(self.idx, self.getGeneration)
+        results = cache.get(key, generation)
+        if results is not None:  # served without a cluster round-trip
+            metrics.count('query.cacheHits')
+            return list(results)  # new list, the cached docs themselves are shared (treat them as read only)
+
+        metrics.count('query.cacheMisses')
+        results = list(self.iterQuery(**kwargs))
+        if len(results) <= self.config['queryCacheMaxDocs']:
+            cache.put(key, generation, results)
+        return list(results)
+
+    def getGeneration(self, index=None):  # changes whenever documents are written/deleted (max seq_no) or new changes become searchable (refresh) in any primary shard
+        index = index or self.idx
+        try:
+            stats = self.es.indices.stats(index=index, metric='refresh', level='shards')
+        except NotFoundError:
+            return None
+        generation = []
+        for name, indexStats in sorted(stats['indices'].items()):  # an alias resolves to its concrete (versioned) indices
+            for shard, copies in sorted(indexStats['shards'].items()):
+                for copy in copies:
+                    if copy['routing']['primary']:
+                        refresh = copy['refresh'].get('external_total', copy['refresh']['total'])
+                        generation.append((name, indexStats.get('uuid'), shard, copy['seq_no']['max_seq_no'], refresh))
+        return tuple(generation)
+
+    @classmethod
+    def invalidateCache(cls, index):  # drop the cached results of an index (called on every write/delete made through this process)
+        if ES_Client.sharedCache is not None:
+            ES_Client.sharedCache.invalidate(index)
 
-        self.resultSet.clear()  # clear global result array for this query
-        qr = self.es.search(index=self.idx, scroll=self.scroll, size=self.scrollSize, body=self.queries[self.q])  # execute initial search and retrieve scroll_id and set size
-        sid = qr['_scroll_id']
-        scroll_size = qr['hits']['total']['value']
-        self.getInnerHits(qr)  # get the _source data and place in global array resultSet
-
-        while int(scroll_size) > 0:  # iterate/scroll the remainder of the query based on scroll_id and scroll size
-            qr = self.es.scroll(scroll_id=sid, scroll=self.scroll)
-            sid = qr['_scroll_id']  # Update the scroll ID
-            scroll_size = len(qr['hits']['hits'])  # Get the number of results that we returned in the last scroll
-            self.getInnerHits(qr)  # get the _source data and place in global array resultSet
-
-        if self.return_size == "all":  # return all records in resultSet
-            return self.resultSet  # return an array of dictionaries containing _source data
-        else:  # return the size requested from the resultSet
-            return self.resultSet[0:self.return_size]  # return an array of dictionaries containing _source data
-
-    def getInnerHits(self,qr):  # get the source ('_source') data from an elasticsearch query and place in global array resultSet
-        for hit in qr['hits']['hits']:
-            self.resultSet.append(hit['_source'])
+    @classmethod
+    def cacheStats(cls):  # hit/miss statistics of the query cache ({} when the cache is disabled)
+        if ES_Client.sharedCache is None:
+            return {}
+        return ES_Client.sharedCache.stats()
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+
+from app.metrics import metrics
+from app.records import decode
+
+
+# Function: client for the upstream covid data feed
+#   Specific Functions:
+#         load()
+#           returns the feed as an array of CovidRecord (compact typed records with real nulls, see app/records.py)
+#           online: serve the on-disk cache while it is younger than ttl seconds, otherwise revalidate it with the
+#                   server (ETag/Last-Modified); a 304 reuses the cached copy, a 200 replaces it
+#                   if the server cannot be reached the cached copy (if any) is used
+#           offline: read a local snapshot (e.g. data/source/covidExample.json), never touches the network
+#           the decoded records are kept in memory: while the file they came from is unchanged (and on a 304) the same array
+#           is returned without reading or decoding anything, so a long running process can call load() on every cycle
+#
+#   Input Params:
+#           url (optional)
+#               defaults to the covidtracking daily feed
+#           cacheDir (optional)
+#               directory holding the cached payload and its validators; defaults to data/cache/
+#           ttl (optional)
+#               seconds a cached payload is served without revalidation; defaults to 3600, 0 always revalidates
+#           offline (optional)
+#               True reads snapshot instead of the network; defaults to False
+#           snapshot (optional)
+#               local file read in offline mode; defaults to data/source/covidExample.json
+
+class Feed_Client:
+    url = 'https://api.covidtracking.com/v1/us/daily.json'
+    cacheDir = 'data/cache/'
+    ttl = 3600  # seconds
+    offline = False
+    snapshot = 'data/source/covidExample.json'
+    timeout = 60  # seconds to wait on the upstream server
+    records = None  # last decoded payload (returned as is while its file is unchanged)
+    recordsKey = None  # (path, inode, size, mtime) of the file records was decoded from
+
+    def __init__(self, **kwargs):
+        self.url = kwargs.get('url', self.url)
+        self.cacheDir = kwargs.get('cacheDir', self.cacheDir)
+        self.ttl = kwargs.get('ttl', self.ttl)
+        self.offline = kwargs.get('offline', self.offline)
+        self.snapshot = kwargs.get('snapshot', self.snapshot)
+        self.cacheFile = os.path.join(self.cacheDir, 'daily.json')
+        self.metaFile = os.path.join(self.cacheDir, 'daily.meta.json')
+
+    def load(self):  # return the feed as an array of CovidRecord
+        with metrics.stage('fetch', offline=self.offline):
+            covidAry = self.loadFeed()
+            metrics.count('fetch.records', len(covidAry))
+        return covidAry
+
+    def loadFeed(self):
+        if self.offline:
+            return self.readFile(self.snapshot)
+
+        if self.isFresh():  # cached copy still inside its ttl, no request at all
+            return self.readFile(self.cacheFile)
+
+        import requests  # only imported when the network is actually needed
+
+        try:
+            return self.fetch()
+        except requests.RequestException as rex:
+            if os.path.exists(self.cacheFile):  # upstream unavailable, fall back to the last good copy
+                print("RequestException: ", rex, " (using cached copy)")
+                return self.readFile(self.cacheFile)
+            raise
+
+    def fetch(self):  # conditional GET against the upstream server; refreshes the cache on a 200
+        import requests
+
+        headers = {}
+        meta = self.readMeta()
+        if os.path.exists(self.cacheFile):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('lastModified'):
+                headers['If-Modified-Since'] = meta['lastModified']
+
+        resp = requests.get(self.url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304:  # unchanged upstream; restart the ttl and reuse the cached payload
+            covidAry = self.readFile(self.cacheFile)
+            os.utime(self.cacheFile)
+            self.recordsKey = self.getFileKey(self.cacheFile)  # touching the file does not change its content
+            return covidAry
+        resp.raise_for_status()
+
+        data = resp.content
+        covidAry = decode(data)  # parse before caching so a bad payload never replaces a good one
+        os.makedirs(self.cacheDir, exist_ok=True)
+        with open(self.cacheFile + '.tmp', 'wb') as cacheFile:
+            cacheFile.write(data)
+        os.replace(self.cacheFile + '.tmp', self.cacheFile)
+        with open(self.metaFile, 'w') as metaFile:
+            json.dump({'etag': resp.headers.get('ETag'), 'lastModified': resp.headers.get('Last-Modified')}, metaFile)
+        self.records = covidAry
+        self.recordsKey = self.getFileKey(self.cacheFile)
+        return covidAry
+
+    def isFresh(self):  # True when the cached payload exists and is younger than ttl seconds
+        if not os.path.exists(self.cacheFile):
+            return False
+        return time.time() - os.path.getmtime(self.cacheFile) < self.ttl
+
+    def readMeta(self):  # cached ETag/Last-Modified validators
+        try:
+            with open(self.metaFile) as metaFile:
+                return json.load(metaFile)
+        except (OSError, ValueError):
+            return {}
+
+    def readFile(self, fqp):  # decoded records of a local file; the previous result is reused while the file is unchanged
+        key = self.getFileKey(fqp)
+        if self.records is not None and key == self.recordsKey:
+            return self.records
+        with open(fqp, 'rb') as feedFile:
+            self.records = decode(feedFile.read())
+        self.recordsKey = key
+        return self.records
+
+    def getFileKey(self, fqp):
+        stat = os.stat(fqp)
+        return (os.path.abspath(fqp), stat.st_ino, stat.st_size, stat.st_mtime_ns)
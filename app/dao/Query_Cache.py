@@ -0,0 +1,80 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+# Function: LRU + TTL cache of query results (used by ES_Client.query when queryCacheSize > 0)
+#   Entries are keyed by (index, query body, return_size) and remember the index generation they were read at
+#   Specific Functions:
+#       get(key, generation)        cached result or None; None when the entry expired (ttl) or the index generation moved on
+#       put(key, generation, value) store a result, evicting the least recently used entry when full
+#       invalidate(index)           drop every entry of an index (called by the client on its own writes/deletes)
+#       getGeneration(index, fetch) index generation, refreshed through fetch() at most every checkInterval seconds
+#       stats()                     hits, misses, evictions, expirations, invalidations and current size
+#
+#   Input Params:
+#       maxsize         max number of cached results (least recently used is evicted first)
+#       ttl             seconds a result is served without being re-read
+#       checkInterval   seconds between generation checks of an index (0 checks on every lookup)
+
+class Query_Cache:
+    maxsize = 128
+    ttl = 300  # seconds
+    checkInterval = 30  # seconds
+
+    def __init__(self, maxsize=None, ttl=None, checkInterval=None):
+        self.maxsize = maxsize or self.maxsize
+        self.ttl = self.ttl if ttl is None else ttl
+        self.checkInterval = self.checkInterval if checkInterval is None else checkInterval
+        self.entries = OrderedDict()  # key: (storedAt, generation, value), oldest use first
+        self.generations = {}  # index: (checkedAt, generation)
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            storedAt, storedGeneration, value = entry
+            if time.monotonic() - storedAt >= self.ttl or storedGeneration != generation:  # too old, or the index changed underneath it
+                del self.entries[key]
+                self.counts['expirations'] += 1
+                self.counts['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts['hits'] += 1
+            return value
+
+    def put(self, key, generation, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), generation, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+    def invalidate(self, index):  # drop the cached results and the known generation of an index
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == index]:
+                del self.entries[key]
+                self.counts['invalidations'] += 1
+            self.generations.pop(index, None)
+
+    def getGeneration(self, index, fetch):  # fetch() is only called when the last check is older than checkInterval
+        with self.lock:
+            checked = self.generations.get(index)
+            if checked is not None and time.monotonic() - checked[0] < self.checkInterval:
+                return checked[1]
+        generation = fetch()
+        with self.lock:
+            self.generations[index] = (time.monotonic(), generation)
+        return generation
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts, size=len(self.entries), maxsize=self.maxsize)
+        lookups = stats['hits'] + stats['misses']
+        stats['hitRatio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
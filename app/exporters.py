@@ -0,0 +1,101 @@
+import csv
+import json
+
+try:  # orjson is optional; fall back to the standard library encoder
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Function: streaming export writers used by Covid.export
+#   Each writer consumes an iterator of documents (dictionaries) and writes them through a buffered file handle,
+#   one document at a time, so memory stays constant regardless of the number of records exported
+#   Targets:
+#       ES      elasticsearch standard json (a single json array of documents)
+#       BULK    elasticsearch _bulk format (action line + document line per record, can be posted straight to _bulk)
+#       KI      kibana importable json (newline delimited json, one document per line)
+#       CSV     csv with headers (taken from the first document)
+
+def dumps(doc):  # encode a document as json bytes (orjson if available, stdlib otherwise)
+    if orjson is not None:
+        return orjson.dumps(doc, default=str)
+    return json.dumps(doc, default=str, ensure_ascii=False).encode('utf-8')
+
+
+class Exporter:
+    fileType = '.json'  # default file extension for this target
+    mode = 'wb'  # file mode; json targets write encoded bytes
+    newline = None  # newline translation (csv needs '')
+    bufferSize = 1024 * 1024  # write buffer size (1MB)
+
+    def __init__(self, fqp, **kwargs):
+        self.fqp = fqp
+        self.idx = kwargs.get('idx', '')
+        self.numRecords = 0
+
+    def write(self, docs):  # write every document from the docs iterator to fqp; returns the number of records written
+        with open(self.fqp, self.mode, buffering=self.bufferSize, newline=self.newline) as exportFile:
+            self.writeHeader(exportFile)
+            for doc in docs:
+                self.writeDoc(exportFile, doc)
+                self.numRecords += 1
+            self.writeFooter(exportFile)
+        return self.numRecords
+
+    def writeHeader(self, exportFile):
+        pass
+
+    def writeDoc(self, exportFile, doc):
+        raise NotImplementedError
+
+    def writeFooter(self, exportFile):
+        pass
+
+
+class ESExporter(Exporter):  # [doc,doc,...]
+    def writeHeader(self, exportFile):
+        exportFile.write(b'[')
+
+    def writeDoc(self, exportFile, doc):
+        if self.numRecords > 0:
+            exportFile.write(b',')
+        exportFile.write(dumps(doc))
+
+    def writeFooter(self, exportFile):
+        exportFile.write(b']')
+
+
+class BulkExporter(Exporter):  # {"index": {...}}\n doc\n
+    fileType = '.ndjson'
+
+    def writeDoc(self, exportFile, doc):
+        action = {'_index': self.idx, '_id': doc.get('hash')} if self.idx else {'_id': doc.get('hash')}
+        exportFile.write(dumps({'index': action}))
+        exportFile.write(b'\n')
+        exportFile.write(dumps(doc))
+        exportFile.write(b'\n')
+
+
+class KIExporter(Exporter):  # doc\n doc\n
+    def writeDoc(self, exportFile, doc):
+        exportFile.write(dumps(doc))
+        exportFile.write(b'\n')
+
+
+class CSVExporter(Exporter):
+    fileType = '.csv'
+    mode = 'w'
+    newline = ''
+    writer = None
+
+    def writeHeader(self, exportFile):
+        self.writer = None
+
+    def writeDoc(self, exportFile, doc):
+        if self.writer is None:  # headers come from the first document
+            self.writer = csv.DictWriter(exportFile, list(doc.keys()), extrasaction='ignore')
+            self.writer.writeheader()
+        self.writer.writerow(doc)
+
+
+exporters = {'ES': ESExporter, 'BULK': BulkExporter, 'KI': KIExporter, 'CSV': CSVExporter}  # export target -> writer class
@@ -0,0 +1,173 @@
+import os
+import re
+import sqlite3
+import datetime
+
+
+# Function: embedded SQL over the curated covid data (used by Covid.search); no elasticsearch needed
+#   Engines:
+#       duckdb      when installed: a view over the parquet store (read_parquet with hive partitions), so duckdb pushes the
+#                   projection and the filters (state partitions included) down into the scan; a DataFrame is registered zero-copy
+#                   when there is no parquet store yet
+#       sqlite      standard library fallback: only the needed columns/state partitions are read (Covid.readCurated) into an
+#                   in-memory table, then the query runs there
+#   The data is always exposed as the table "covid" (date is a timestamp, the rest as curated)
+#
+#   Filter DSL (the predicate syntax of Covid.getSelector):
+#       where=['state==NY', 'date>=20200401', 'deathIncrease>100']     ANDed; ==, !=, >=, <=, >, <; dates as YYYYmmdd or YYYY-mm-dd
+#       columns=['date', 'state', 'deathIncrease'], orderBy='deathIncrease desc', limit=10
+#
+#   Use Case:
+#       sql = LocalSQL(storePath, covid.readCurated)
+#       df = sql.query('select state, sum(deathIncrease) as deaths from covid group by state order by deaths desc')
+#       for row in sql.query(*toSQL(['state==NY'], ['date', 'death']), iterator=True): ...
+
+predicatePattern = re.compile(r'^(\w+)\s*(==|!=|>=|<=|>|<)\s*(.+)$')
+orderPattern = re.compile(r'^(\w+)(?:\s+(asc|desc))?$', re.IGNORECASE)
+sqlOps = {'==': '=', '!=': '!=', '>=': '>=', '<=': '<=', '>': '>', '<': '<'}
+fetchSize = 1000  # rows per fetch when iterating
+
+
+def parsePredicates(where):  # ['state==NY', ...] -> [(col, op, value)] with typed values (datetime for date, numbers, strings)
+    predicates = []
+    for item in where or []:
+        match = predicatePattern.match(str(item).strip())
+        if not match:
+            raise ValueError("cannot parse predicate: " + str(item) + " (expected column op value, e.g. state==NY)")
+        col, op, value = match.groups()
+        predicates.append((col, op, toValue(col, value.strip().strip('"').strip("'"))))
+    return predicates
+
+
+def toValue(col, value):
+    if col == 'date':
+        return datetime.datetime.strptime(value.replace('-', '')[:8], '%Y%m%d')
+    if re.match(r'^-?\d+$', value):
+        return int(value)
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def toSQL(where=None, columns=None, orderBy=None, limit=None, table='covid'):  # filter DSL -> (sql, params)
+    predicates = parsePredicates(where)
+    select = ', '.join('"' + checkName(col) + '"' for col in columns) if columns else '*'
+    sql = 'SELECT ' + select + ' FROM ' + table
+    params = []
+    if predicates:
+        sql += ' WHERE ' + ' AND '.join('"' + col + '" ' + sqlOps[op] + ' ?' for col, op, value in predicates)
+        params = [value for col, op, value in predicates]
+    if orderBy:
+        match = orderPattern.match(orderBy.strip())
+        if not match:
+            raise ValueError("cannot parse orderBy: " + orderBy + " (expected column [asc|desc])")
+        sql += ' ORDER BY "' + match.group(1) + '" ' + (match.group(2) or 'asc').upper()
+    if limit is not None:
+        sql += ' LIMIT ' + str(int(limit))
+    return sql, params
+
+
+def toESQuery(where):  # filter DSL -> elasticsearch bool query (date as the indexed YYYYmmdd integer)
+    filters = []
+    mustNot = []
+    ranges = {'>=': 'gte', '<=': 'lte', '>': 'gt', '<': 'lt'}
+    for col, op, value in parsePredicates(where):
+        if isinstance(value, datetime.datetime):
+            value = int(value.strftime('%Y%m%d'))
+        if op == '==':
+            filters.append({"term": {col: value}})
+        elif op == '!=':
+            mustNot.append({"term": {col: value}})
+        else:
+            filters.append({"range": {col: {ranges[op]: value}}})
+    return {"query": {"bool": {"filter": filters, "must_not": mustNot}}}
+
+
+def getNeeded(where=None, columns=None, orderBy=None):  # columns and states a DSL query touches (None = everything)
+    predicates = parsePredicates(where)
+    needed = None
+    if columns:
+        needed = list(dict.fromkeys(list(columns) + [col for col, op, value in predicates] + ([orderBy.split()[0]] if orderBy else [])))
+    states = None
+    for col, op, value in predicates:
+        if col == 'state' and op == '==':
+            states = [value] if states in (None, [value]) else []  # two different states can never both match
+    return needed, states
+
+
+def checkName(col):
+    if not re.match(r'^\w+$', col):
+        raise ValueError("invalid column name: " + col)
+    return col
+
+
+class LocalSQL:
+    engine = 'auto'  # auto (duckdb when installed, otherwise sqlite), duckdb or sqlite
+
+    def __init__(self, storePath, readCurated, engine=None):  # readCurated(columns, states) -> DataFrame (see Covid.readCurated)
+        self.storePath = storePath
+        self.readCurated = readCurated
+        self.hasStore = os.path.isdir(storePath)
+        self.engine = engine or self.engine
+        if self.engine == 'auto':
+            try:
+                import duckdb  # optional dependency
+                self.engine = 'duckdb'
+            except ImportError:
+                self.engine = 'sqlite'
+
+    def query(self, sql, params=None, iterator=False, columns=None, states=None):  # DataFrame (or an iterator of dictionaries); columns/states limit what the sqlite fallback loads
+        if self.engine == 'duckdb':
+            con = self.getDuckDB()
+        else:
+            con = self.getSQLite(columns, states)
+            params = [value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime.datetime) else value for value in params or []]  # same text form as the stored timestamps
+        cursor = con.execute(sql, params or [])
+        if iterator:
+            return self.iterRows(cursor)
+        return self.toFrame(cursor)
+
+    def getDuckDB(self):
+        import duckdb
+
+        con = duckdb.connect()
+        if self.hasStore:  # a view over the files; nothing is read until a query runs and only what it needs is scanned
+            glob = os.path.join(self.storePath, '**', '*.parquet').replace("'", "''")
+            con.execute("CREATE VIEW covid AS SELECT * FROM read_parquet('" + glob + "', hive_partitioning = true)")
+        else:
+            con.register('covid', self.readCurated())  # zero-copy scan of the DataFrame
+        return con
+
+    def getSQLite(self, columns=None, states=None):
+        con = sqlite3.connect(':memory:')
+        df = self.readCurated(columns, states)
+        for col in df.columns:
+            if str(df[col].dtype) == 'category':
+                df[col] = df[col].astype(str)
+        df.to_sql('covid', con, index=False)  # timestamps are stored as 'YYYY-mm-dd HH:MM:SS' text
+        return con
+
+    def toFrame(self, cursor):
+        import pandas as pd
+
+        if self.engine == 'duckdb':
+            return cursor.df()
+        names = [d[0] for d in cursor.description]
+        df = pd.DataFrame.from_records(cursor.fetchall(), columns=names)
+        if 'date' in df.columns:
+            df['date'] = pd.to_datetime(df['date'])
+        return df
+
+    def iterRows(self, cursor):  # dictionaries with the date in its feed form (YYYYmmdd integer)
+        names = [d[0] for d in cursor.description]
+        while True:
+            rows = cursor.fetchmany(fetchSize)
+            if not rows:
+                return
+            for row in rows:
+                doc = dict(zip(names, row))
+                if doc.get('date') is not None:
+                    doc['date'] = int(str(doc['date'])[:10].replace('-', ''))
+                yield doc
+
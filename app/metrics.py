@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+unset = object()  # configure() default: leave that setting as it is
+
+
+# Function: per stage timing, counters and (optional) peak memory for the loader
+#   metrics (the process wide Metrics instance) is used throughout the app:
+#       with metrics.stage('curate.frame'):      time a block; nested stages are recorded separately
+#           ...
+#       metrics.count('export.records', 2112)   add to a counter
+#   Each finished stage is kept in metrics.records (the most recent maxRecords only, so a long running daemon does not grow) and,
+#   when an output is configured, written straight away as a json line (Prometheus text is produced on demand by toPrometheus())
+#
+#   Configuration (metrics.configure(...) or environment variables):
+#       output          file to append json lines to, '-' for stdout         COVID_METRICS=path
+#       traceMemory     capture the tracemalloc peak of each stage           COVID_METRICS_MEMORY=1
+#       maxRecords      finished stages kept in memory (oldest dropped first)
+#   configure() only changes the settings it is given (configure(maxRecords=100) keeps the output and traceMemory settings)
+#
+#   Use Case:
+#       metrics.configure(output='-', traceMemory=True)
+#       covid19.curate()
+#       print(metrics.toPrometheus())
+
+class Metrics:
+    output = None
+    traceMemory = False
+    maxRecords = 10000
+
+    def __init__(self):
+        self.records = deque(maxlen=self.maxRecords)  # most recent finished stages: {'stage', 'labels', 'seconds', 'peakBytes', 'counters'}
+        self.counters = {}  # process totals
+        self.lock = threading.Lock()
+        self.local = threading.local()  # stack of open stages per thread
+        self.configure(output=os.environ.get('COVID_METRICS'), traceMemory=os.environ.get('COVID_METRICS_MEMORY') == '1')
+
+    def configure(self, output=unset, traceMemory=unset, maxRecords=unset):
+        if output is not unset:
+            self.output = output
+        if traceMemory is not unset:
+            self.traceMemory = traceMemory
+        if maxRecords is not unset and maxRecords is not None and maxRecords != self.records.maxlen:
+            with self.lock:
+                self.maxRecords = maxRecords
+                self.records = deque(self.records, maxlen=maxRecords)
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def reset(self):
+        with self.lock:
+            self.records = deque(maxlen=self.maxRecords)
+            self.counters = {}
+
+    @contextmanager
+    def stage(self, name, **labels):  # time (and optionally memory) a block of work
+        stack = self.getStack()
+        record = {'stage': name, 'labels': labels, 'seconds': 0.0, 'peakBytes': None, 'counters': {}}
+        if self.traceMemory:
+            if stack:  # remember the parent's peak so far before resetting the peak for this stage
+                stack[-1]['peakBytes'] = max(stack[-1]['peakBytes'] or 0, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            record['startBytes'] = tracemalloc.get_traced_memory()[0]
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            stack.pop()
+            if self.traceMemory:
+                peak = tracemalloc.get_traced_memory()[1]
+                record['peakBytes'] = max(record['peakBytes'] or 0, peak) - record.pop('startBytes')  # memory above what was allocated when the stage started
+                if stack:
+                    stack[-1]['peakBytes'] = max(stack[-1]['peakBytes'] or 0, peak)
+            self.emit(record)
+
+    def count(self, name, value=1):  # add to a counter on the innermost open stage and to the process totals
+        stack = self.getStack()
+        if stack:
+            stack[-1]['counters'][name] = stack[-1]['counters'].get(name, 0) + value
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def getStack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def emit(self, record):
+        with self.lock:
+            self.records.append(record)
+        if not self.output:
+            return
+        line = json.dumps(dict(record, ts=time.time()), default=str) + "\n"
+        if self.output == '-':
+            sys.stdout.write(line)
+        else:
+            with self.lock, open(self.output, 'a') as metricsFile:
+                metricsFile.write(line)
+
+    def toPrometheus(self):  # Prometheus text exposition of the stage timings/peaks (last run of each stage) and the counter totals
+        lines = ['# TYPE covid_stage_seconds gauge', '# TYPE covid_stage_peak_bytes gauge', '# TYPE covid_total counter']
+        latest = {}
+        for record in self.records:
+            latest[(record['stage'], tuple(sorted(record['labels'].items())))] = record
+        for (stage, labels), record in latest.items():
+            labelText = ','.join(['stage="' + stage + '"'] + [k + '="' + str(v) + '"' for k, v in labels])
+            lines.append('covid_stage_seconds{' + labelText + '} ' + str(record['seconds']))
+            if record['peakBytes'] is not None:
+                lines.append('covid_stage_peak_bytes{' + labelText + '} ' + str(record['peakBytes']))
+        for name, value in sorted(self.counters.items()):
+            lines.append('covid_total{name="' + name + '"} ' + str(value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
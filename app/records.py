@@ -0,0 +1,126 @@
+import json
+from collections import namedtuple
+
+try:  # orjson is optional; fall back to the standard library decoder
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Function: compact typed record for the covid feed (one per state per day)
+#   A CovidRecord is a tuple with one slot per field of the payload (no per record dictionary) and real nulls instead of the
+#   feed's "None" strings. The record type is built from the payload's key set: the snapshot fields (feedFields) first, then every
+#   other key the payload carries (lastModified, dataQualityGrade, *Viral, ...) in first seen order. One type (one shared field
+#   layout) exists per key set, so upstream schema additions cost a slot per record instead of a dictionary per record. Fields a
+#   record did not carry are None. Low cardinality strings (state, dateChecked, fips, grades, timestamps) are shared between records.
+#
+#   Specific Functions:
+#       decode(data)            feed payload (bytes/str) -> array of CovidRecord; the "None" sentinels are turned into json nulls before
+#                               parsing and each parsed document is replaced by its record as soon as it is converted
+#       fromDocs(docs)          array of feed dictionaries -> array of CovidRecord (converted in place)
+#       record.toDict()         feed shaped dictionary (every field of the record type, nulls as None) for exporters and _bulk
+#       toColumns(records)      {field: tuple of values} for building a DataFrame; a single transpose, no dictionary per record
+#       record.date, record['date'], record.get('hash')     attribute and dictionary style reads both work
+#
+#   Use Case:
+#       covidAry = decode(payload)
+#       docs = (doc.toDict() for doc in covidAry if doc.date >= 20200301)
+
+feedFields = ('date', 'state', 'positive', 'negative', 'pending', 'hospitalizedCurrently', 'hospitalizedCumulative', 'inIcuCurrently',
+              'inIcuCumulative', 'onVentilatorCurrently', 'onVentilatorCumulative', 'recovered', 'hash', 'dateChecked', 'death', 'hospitalized',
+              'total', 'totalTestResults', 'posNeg', 'fips', 'deathIncrease', 'hospitalizedIncrease', 'negativeIncrease', 'positiveIncrease',
+              'totalTestResultsIncrease')  # present (in this order) on every record type; attribute access to these never changes
+sharedFields = ('state', 'dateChecked', 'fips', 'dataQualityGrade', 'grade', 'lastUpdateEt', 'checkTimeEt', 'dateModified', 'lastModified',
+                'totalTestResultsSource')  # low cardinality strings, one copy each
+recordTypes = {}  # field tuple -> CovidRecord type
+
+
+class CovidRecord(tuple):  # base of every record type (see getRecordType); isinstance(doc, CovidRecord) holds for all of them
+    __slots__ = ()
+    _keys = ()  # payload field names in slot order
+    _positions = {}  # field name -> slot
+
+    def __getitem__(self, field):  # record['date'] as well as record[0]
+        if isinstance(field, str):
+            try:
+                return tuple.__getitem__(self, self._positions[field])
+            except KeyError:
+                raise KeyError(field) from None
+        return tuple.__getitem__(self, field)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def toDict(self):
+        return dict(zip(self._keys, self))
+
+    def __reduce__(self):  # record types are built at run time; pickle through the field tuple
+        return makeRecord, (self._keys, tuple(self))
+
+
+def getRecordType(fields):  # the record type of a field tuple (created once per key set)
+    recordType = recordTypes.get(fields)
+    if recordType is None:
+        base = namedtuple('CovidRecordFields', fields, rename=True)  # attribute access (keys that are not identifiers stay reachable by name)
+        recordType = type('CovidRecord', (CovidRecord, base), {'__slots__': (), '_keys': fields, '_positions': {field: i for i, field in enumerate(fields)}})
+        recordTypes[fields] = recordType
+    return recordType
+
+
+def makeRecord(fields, values):
+    return tuple.__new__(getRecordType(fields), values)
+
+
+def getFields(docs):  # feedFields followed by every other key found in the dictionaries of docs (first seen order)
+    known = set(feedFields)
+    extra = []
+    for doc in docs:
+        if isinstance(doc, dict) and not known.issuperset(doc):
+            for key in doc:
+                if key not in known:
+                    known.add(key)
+                    extra.append(key)
+    return feedFields + tuple(extra)
+
+
+def loads(data):  # parse json bytes/str (orjson if available, stdlib otherwise)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode(data):  # feed payload -> array of CovidRecord
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return fromDocs(loads(data.replace(b'"None"', b'null')), sentinels=False)  # the feed only ever uses "None" as a null sentinel
+
+
+def fromDocs(docs, sentinels=True):  # convert an array of feed dictionaries in place (records are left as they are); sentinels=False skips the "None" check
+    fields = getFields(docs)
+    recordType = getRecordType(fields)
+    new = tuple.__new__
+    shared = {}
+    sharedPositions = [recordType._positions[field] for field in sharedFields if field in recordType._positions]
+    for i, doc in enumerate(docs):
+        if isinstance(doc, CovidRecord):
+            continue
+        values = list(map(doc.get, fields))
+        if sentinels:
+            values = [None if value == 'None' else value for value in values]
+        for pos in sharedPositions:
+            values[pos] = shared.setdefault(values[pos], values[pos])
+        docs[i] = new(recordType, values)
+    return docs
+
+
+def toColumns(records):  # column tuples in field order; records of different types (key sets) are padded with None
+    if not records:
+        return {field: () for field in feedFields}
+    recordType = type(records[0])
+    if all(type(record) is recordType for record in records):  # one layout: a single transpose
+        return dict(zip(recordType._keys, zip(*records)))
+    fields = list(dict.fromkeys(field for kind in dict.fromkeys(map(type, records)) for field in kind._keys))
+    return {field: tuple(record.get(field) for record in records) for field in fields}
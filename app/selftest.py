@@ -0,0 +1,534 @@
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+import threading
+import http.server
+
+
+# Function: self checks against local stubs (python -m app selftest); no elasticsearch or network needed (the feed is the offline snapshot)
+#   Checks:
+#       async       ES_AsyncClient and covid_async.run against an aiohttp stub elasticsearch: checkIndex, insert (insertLatest,
+#                   the index template it puts first, its high-water mark and 429 retries), query, deleteRange, deleteIndex of an alias and the concurrency limit of run()
+#       daemon      Covid_Daemon on a FakeClock against a threaded http.server stub elasticsearch: first ingest, idle cycles
+#                   (skipped, no requests), a changed feed (only the diff is sent, the replaced id is deleted), a failed bulk
+#                   (hash map kept, retried next tick), curated rows (not raw feed records) in the index, coalescing of an
+#                   overrunning job, stop() and the empty schedule error
+#       feed        Feed_Client against a threaded http.server stand-in for the upstream feed: first download (200), a ttl hit (no
+#                   request, same array), revalidation (304, same array), a changed feed (200, new array) and the cached copy
+#                   when the server is down
+#       sources     sources.streamSources on the local datasets: the full merged stream, and a consumer that stops after a few
+#                   documents (closing the generator must not hang on workers blocked on the full queue)
+#   every check prints one ok/FAIL line per expectation; run() returns the number of failures (the command exits non zero on any)
+#
+#   Use Case:
+#       python -m app selftest
+#       python -m app selftest async
+#       python -m app selftest daemon
+#       python -m app selftest feed
+#       python -m app selftest sources
+
+def makeAsyncStub():  # aiohttp application answering the elasticsearch apis ES_AsyncClient uses; state holds the stored docs and request stats
+    from aiohttp import web
+
+    state = {'indices': {}, 'aliases': {}, 'tasks': {}, 'templates': {}, 'reject': 0, 'inFlight': 0, 'maxInFlight': 0, 'delay': 0, 'requests': 0}
+    headers = {'X-Elastic-Product': 'Elasticsearch'}
+
+    @web.middleware
+    async def track(request, handler):  # count requests in flight (the concurrency check reads maxInFlight)
+        state['requests'] += 1
+        state['inFlight'] += 1
+        state['maxInFlight'] = max(state['maxInFlight'], state['inFlight'])
+        try:
+            if state['delay']:
+                await asyncio.sleep(state['delay'])
+            return await handler(request)
+        finally:
+            state['inFlight'] -= 1
+
+    async def info(request):
+        return web.json_response({'version': {'number': '7.17.0', 'build_flavor': 'default'}, 'tagline': 'You Know, for Search'}, headers=headers)
+
+    async def exists(request):  # indices and aliases both exist
+        idx = request.match_info['idx']
+        return web.Response(status=200 if idx in state['indices'] or idx in state['aliases'] else 404, headers=headers)
+
+    async def putTemplate(request):
+        state['templates'][request.match_info['name']] = json.loads(await request.read())
+        return web.json_response({'acknowledged': True}, headers=headers)
+
+    async def createIndex(request):
+        state['indices'].setdefault(request.match_info['idx'], {})
+        return web.json_response({'acknowledged': True, 'index': request.match_info['idx']}, headers=headers)
+
+    async def deleteIndex(request):  # like elasticsearch 7, an alias cannot be deleted by name
+        names = request.match_info['idx'].split(',')
+        if any(name in state['aliases'] for name in names):
+            error = {'type': 'illegal_argument_exception', 'reason': 'The provided expression [' + ','.join(names) + '] matches an alias, specify the corresponding concrete indices instead.'}
+            return web.json_response({'error': error, 'status': 400}, status=400, headers=headers)
+        for name in names:
+            state['indices'].pop(name, None)
+            for alias, indices in list(state['aliases'].items()):
+                if name in indices:
+                    indices.remove(name)
+                    if not indices:
+                        del state['aliases'][alias]
+        return web.json_response({'acknowledged': True}, headers=headers)
+
+    async def alias(request):
+        name = request.match_info['name']
+        if name not in state['aliases']:
+            return web.json_response({'error': 'alias [' + name + '] missing', 'status': 404}, status=404, headers=headers)
+        return web.json_response({index: {'aliases': {name: {}}} for index in state['aliases'][name]}, headers=headers)
+
+    async def bulk(request):  # the first state['reject'] documents are rejected with 429 (back-pressure)
+        lines = [line for line in (await request.read()).split(b'\n') if line]
+        items = []
+        i = 0
+        while i < len(lines):
+            op, meta = next(iter(json.loads(lines[i]).items()))
+            docs = state['indices'].setdefault(meta['_index'], {})
+            if state['reject'] > 0 and op != 'delete':
+                state['reject'] -= 1
+                i += 2
+                items.append({op: {'_index': meta['_index'], '_id': meta['_id'], 'status': 429, 'error': {'type': 'es_rejected_execution_exception', 'reason': 'rejected by the stub'}}})
+                continue
+            if op == 'delete':
+                docs.pop(meta['_id'], None)
+                i += 1
+            else:
+                docs[meta['_id']] = json.loads(lines[i + 1])
+                i += 2
+            items.append({op: {'_index': meta['_index'], '_id': meta['_id'], 'status': 200}})
+        return web.json_response({'took': 1, 'errors': any(item[next(iter(item))]['status'] >= 300 for item in items), 'items': items}, headers=headers)
+
+    async def search(request):
+        body = json.loads(await request.read() or b'{}')
+        docs = list(state['indices'].get(request.match_info['idx'], {}).values())
+        if 'aggs' in body:  # size:0 metric aggregations (summary)
+            aggs = {}
+            for name, agg in body['aggs'].items():
+                aggType, params = next(iter(agg.items()))
+                values = [doc[params['field']] for doc in docs if doc.get(params['field']) is not None]
+                aggs[name] = {'value': {'max': max, 'min': min, 'sum': sum, 'value_count': len}[aggType](values) if values else None}
+            return web.json_response({'hits': {'hits': []}, 'aggregations': aggs}, headers=headers)
+        for sort in reversed(body.get('sort', [])):
+            field, order = next(iter(sort.items()))
+            docs.sort(key=lambda doc: doc.get(field) or 0, reverse=order['order'] == 'desc')
+        size = int(request.query.get('size', 10))
+        return web.json_response({'_scroll_id': 'scroll-1', 'hits': {'hits': [{'_source': doc} for doc in docs[:size]]}}, headers=headers)
+
+    async def scroll(request):  # everything fits in the first page
+        if request.method == 'DELETE':
+            return web.json_response({'succeeded': True, 'num_freed': 1}, headers=headers)
+        return web.json_response({'_scroll_id': 'scroll-1', 'hits': {'hits': []}}, headers=headers)
+
+    async def deleteByQuery(request):  # date range (or match_all) delete, run as a task that is already complete when polled
+        body = json.loads(await request.read())
+        docs = state['indices'].get(request.match_info['idx'], {})
+        dateRange = body['query'].get('range', {}).get('date', {})
+        matched = [key for key, doc in docs.items() if doc['date'] >= dateRange.get('gte', 0) and doc['date'] <= dateRange.get('lte', 99999999)]
+        for key in matched:
+            del docs[key]
+        taskId = 'stub:' + str(len(state['tasks']) + 1)
+        result = {'deleted': len(matched), 'total': len(matched), 'failures': [], 'took': 1}
+        state['tasks'][taskId] = {'completed': True, 'task': {'id': taskId, 'status': result}, 'response': result}
+        return web.json_response({'task': taskId}, headers=headers)
+
+    async def task(request):
+        return web.json_response(state['tasks'][request.match_info['taskId']], headers=headers)
+
+    app = web.Application(middlewares=[track])
+    app.router.add_get('/', info)
+    app.router.add_post('/_bulk', bulk)
+    app.router.add_route('*', '/_search/scroll', scroll)
+    app.router.add_get('/_tasks/{taskId}', task)
+    app.router.add_route('*', '/_alias/{name}', alias)
+    app.router.add_put('/_index_template/{name}', putTemplate)
+    app.router.add_route('HEAD', '/{idx}', exists)
+    app.router.add_get('/{idx}', exists, allow_head=False)  # the aiohttp connection of elasticsearch-py 7.x sends indices.exists as a GET
+    app.router.add_put('/{idx}', createIndex)
+    app.router.add_delete('/{idx}', deleteIndex)
+    app.router.add_route('*', '/{idx}/_search', search)
+    app.router.add_post('/{idx}/_delete_by_query', deleteByQuery)
+    return app, state
+
+
+class StubES(http.server.BaseHTTPRequestHandler):  # synchronous elasticsearch stub for ES_Client (selftest and bench); the server's state holds docs per index and a request log
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are separate writes; without this every single document request waits on a delayed ack
+
+    def send(self, status, obj=None):
+        body = json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(status)
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read(self):
+        import gzip
+
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.state['requests'].append((self.command, self.path.split('?')[0]))
+        return body
+
+    def do_HEAD(self):  # index exists
+        self.read()
+        self.send(200 if self.path.split('?')[0].strip('/') in self.server.state['indices'] else 404)
+
+    def do_GET(self):  # index stats, index settings or cluster info
+        self.read()
+        index = self.path.split('?')[0].strip('/').split('/')[0]
+        if '/_stats' in self.path:
+            docs = self.server.state['indices'].get(index, {})
+            self.send(200, {'_all': {'primaries': {'docs': {'count': len(docs)}, 'store': {'size_in_bytes': 1}}}})
+        elif '/_settings' in self.path:  # read by setBulkProfile (loads of bulkProfileMin+ docs)
+            self.send(200, {index: {'settings': {'index': {'refresh_interval': '1s', 'number_of_replicas': '1'}}}})
+        else:
+            self.send(200, {'version': {'number': '7.17.0', 'build_flavor': 'default'}, 'tagline': 'You Know, for Search'})
+
+    def do_PUT(self):  # single document, create index / put template / index settings
+        body = self.read()
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) >= 3:  # PUT /<index>/_doc/<id>
+            self.indexDoc(parts, body)
+            return
+        if not parts[0].startswith('_'):
+            self.server.state['indices'].setdefault(parts[0], {})
+        self.send(200, {'acknowledged': True})
+
+    def do_POST(self):  # _bulk, _refresh or a single document; ids in state['failIds'] are rejected with a mapping error
+        state = self.server.state
+        body = self.read()
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts[-1] == '_refresh':
+            self.send(200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+            return
+        if parts[-1] != '_bulk':
+            if len(parts) >= 3:  # POST /<index>/_doc/<id>
+                self.indexDoc(parts, body)
+                return
+            self.send(400, {'error': {'type': 'illegal_argument_exception', 'reason': 'the stub only answers _bulk and single documents'}, 'status': 400})
+            return
+        lines = [line for line in body.split(b'\n') if line]
+        items = []
+        i = 0
+        while i < len(lines):
+            op, meta = next(iter(json.loads(lines[i]).items()))
+            docs = state['indices'].setdefault(meta['_index'], {})
+            i += 1
+            if meta['_id'] in state['failIds']:
+                i += op != 'delete'
+                items.append({op: {'_index': meta['_index'], '_id': meta['_id'], 'status': 400, 'error': {'type': 'mapper_parsing_exception', 'reason': 'rejected by the stub'}}})
+                continue
+            if op == 'delete':
+                docs.pop(meta['_id'], None)
+            else:
+                if state['store']:
+                    docs[meta['_id']] = json.loads(lines[i])
+                i += 1
+            items.append({op: {'_index': meta['_index'], '_id': meta['_id'], 'status': 200}})
+        self.send(200, {'took': 1, 'errors': any(item[next(iter(item))]['status'] >= 300 for item in items), 'items': items})
+
+    def indexDoc(self, parts, body):
+        index, docType, docId = parts[:3]
+        if self.server.state['store']:
+            self.server.state['indices'].setdefault(index, {})[docId] = json.loads(body)
+        self.send(201, {'_index': index, '_type': docType, '_id': docId, '_version': 1, 'result': 'created'})
+
+    def log_message(self, *args):
+        pass
+
+
+def startStubES(store=True):  # StubES on a free local port in a background thread; store=False only acknowledges documents (bench sized loads)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubES)
+    server.state = {'indices': {}, 'requests': [], 'failIds': set(), 'store': store}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def expect(results, name, passed, detail=''):
+    results.append((name, bool(passed)))
+    print(("ok   " if passed else "FAIL ") + name + (": " + str(detail) if detail != '' else ''))
+
+
+async def runAsyncChecks(results):
+    from aiohttp import web
+    from app import covid_async
+    from app.dao.ES_AsyncClient import ES_AsyncClient
+    from app.dao.Feed_Client import Feed_Client
+
+    app, state = makeAsyncStub()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    savedHosts = os.environ.get('ES_HOSTS')
+    os.environ['ES_HOSTS'] = '127.0.0.1:' + str(runner.addresses[0][1])
+    client = ES_AsyncClient('covid-19')
+    try:
+        feedSize = len(Feed_Client(offline=True).load())
+        expect(results, 'async checkIndex before insert', not await client.checkIndex('covid-19'))
+
+        counts = (await covid_async.run([('covid-19', {'action': 'insertLatest', 'doc_type': '_doc'})], offline=True))[0]
+        stored = state['indices'].get('covid-19', {})
+        expect(results, 'async insert', counts['indexed'] == feedSize == len(stored) and counts['failed'] == 0, str(counts['indexed']) + ' of ' + str(feedSize))
+        expect(results, 'async checkIndex after insert', await client.checkIndex('covid-19'))
+        template = state['templates'].get('covid-19', {})
+        expect(results, 'async insert puts the index template first', 'covid-19-*' in template.get('index_patterns', []) and 'mappings' in template.get('template', {}), list(state['templates']))
+
+        again = (await covid_async.run([('covid-19', {'action': 'insertLatest', 'doc_type': '_doc'})], offline=True))[0]
+        expect(results, 'async insert above the high-water mark only', again['attempted'] == 0, again['attempted'])
+
+        client.config['bulkInitialBackoff'] = 0  # retry right away
+        state['reject'] = 5
+        retried = await client.insert('_doc', [dict(doc, hash='selftest-429-' + str(i)) for i, doc in enumerate(list(stored.values())[:20])], chunkSize=10)
+        expect(results, 'async insert re-sends documents rejected with 429', retried['indexed'] == 20 and retried['failed'] == 0 and state['reject'] == 0, retried)
+        for i in range(20):
+            stored.pop('selftest-429-' + str(i), None)
+
+        docs = [doc async for doc in client.query(q='getMaxDate', return_size=3)]
+        maxDate = max(doc['date'] for doc in stored.values())
+        expect(results, 'async query', len(docs) == 3 and all(doc['date'] == maxDate for doc in docs), [doc['date'] for doc in docs])
+
+        inRange = sum(1 for doc in stored.values() if 20200401 <= doc['date'] <= 20200405)
+        summary = await client.deleteRange('20200401', '20200405', pollInterval=0)
+        left = [doc['date'] for doc in state['indices']['covid-19'].values()]
+        expect(results, 'async deleteRange', summary['deleted'] == inRange > 0 and not any(20200401 <= date <= 20200405 for date in left), summary)
+
+        state['indices']['covid-19-v1'] = {}  # after a rebuild the index name is an alias of a versioned index
+        state['aliases']['covid-19-v'] = ['covid-19-v1']
+        await ES_AsyncClient('covid-19-v', es=client.es).deleteIndex()
+        expect(results, 'async deleteIndex of an alias', 'covid-19-v1' not in state['indices'] and 'covid-19-v' not in state['aliases'])
+
+        state['delay'] = 0.05  # every request takes a while, so jobs overlap as much as the limit allows
+        state['maxInFlight'] = 0
+        checks = await covid_async.run([('covid-19', {'action': 'checkIndex'})] * 8, limit=3)
+        state['delay'] = 0
+        expect(results, 'async concurrency limit', all(checks) and 1 < state['maxInFlight'] <= 3, 'max in flight ' + str(state['maxInFlight']) + ' (limit 3)')
+    finally:
+        await client.close()
+        if savedHosts is None:
+            os.environ.pop('ES_HOSTS', None)
+        else:
+            os.environ['ES_HOSTS'] = savedHosts
+        await runner.cleanup()
+
+
+def checkAsync(results):
+    asyncio.run(runAsyncChecks(results))
+
+
+def quietly(func, *args, **kwargs):  # call func with its progress prints swallowed
+    import io
+    from contextlib import redirect_stdout
+
+    with redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def checkDaemon(results):
+    from app.daemon import Covid_Daemon, FakeClock
+    from app.dao.ES_Client import ES_Client
+
+    server = startStubES()
+    state = server.state
+    savedHosts = os.environ.get('ES_HOSTS')
+    os.environ['ES_HOSTS'] = '127.0.0.1:' + str(server.server_port)
+    ES_Client.sharedClient = None  # point the shared client at the stub
+    tmp = tempfile.mkdtemp()
+    try:
+        snapshot = os.path.join(tmp, 'feed.json')
+        shutil.copy('data/source/covidExample.json', snapshot)
+        clock = FakeClock()
+        daemon = Covid_Daemon('covid-19', schedule={'ingest': 60, 'curate': 120, 'export': 300}, clock=clock, offline=True, snapshot=snapshot)
+        daemon.exportDir = tmp + '/'
+        daemon.covid.exportPath = os.path.join(tmp, 'currentCovid.json')
+        daemon.covid.storePath = os.path.join(tmp, 'currentCovid.parquet')
+        daemon.covid.manifestFile = os.path.join(tmp, 'curateManifest.json')
+        with open(snapshot) as f:
+            feed = json.load(f)
+
+        state['failIds'] = {doc['hash'] for doc in feed[:3]}  # the first ingest loses three documents
+        counts = quietly(daemon.run, cycles=1)
+        stored = state['indices'].get('covid-19', {})
+        expect(results, 'daemon failed first ingest keeps nothing indexed', counts['failed'] == 1 and daemon.indexed == {} and len(stored) == len(feed) - 3,
+               str(len(stored)) + ' of ' + str(len(feed)) + ' stored, counts ' + str(counts))
+        expect(results, 'daemon other jobs still run', counts['runs'] == 2 and any(name.startswith('currentCSV') for name in os.listdir(tmp)), counts)
+
+        state['failIds'] = set()
+        quietly(daemon.run, cycles=1)  # next ingest tick: the same (full) diff is sent again
+        expect(results, 'daemon failed ingest retried on the next tick', len(stored) == len(feed) and len(daemon.indexed) == len(feed) and daemon.doneVersion['ingest'] == daemon.version,
+               str(len(stored)) + ' of ' + str(len(feed)) + ' stored at ' + str(clock.now()) + 's')
+        raw = [key for key, doc in stored.items() if 'dateTrack' not in doc]
+        expect(results, 'daemon indexes curated rows', not raw, str(len(raw)) + ' documents without dateTrack')
+
+        del state['requests'][:]
+        runs = daemon.counts['runs']
+        counts = quietly(daemon.run, cycles=3)
+        expect(results, 'daemon idle cycles are skipped without requests', counts['runs'] == runs and counts['skipped'] >= 3 and not state['requests'], state['requests'][:3])
+
+        new = dict(feed[0], date=feed[0]['date'] + 1, hash='selftest-new')  # upstream adds a day and revises an older record
+        revised = feed[5]
+        oldHash = revised['hash']
+        revised.update(hash='selftest-revised', death=(revised['death'] or 0) + 1)
+        with open(snapshot, 'w') as f:
+            json.dump([new] + feed, f)
+        del state['requests'][:]
+        newRecords = daemon.counts['newRecords']
+        quietly(daemon.run, cycles=2)
+        sent = [path for method, path in state['requests'] if path == '/_bulk']
+        expect(results, 'daemon changed feed sends only the diff', daemon.counts['newRecords'] - newRecords == 2 and 'selftest-new' in stored and 'selftest-revised' in stored
+               and oldHash not in stored and len(stored) == len(feed) + 1, str(daemon.counts['newRecords'] - newRecords) + ' new/changed in ' + str(len(sent)) + ' _bulk requests')
+        expect(results, 'daemon diff indexes curated rows', 'dateTrack' in stored.get('selftest-new', {}) and 'dateTrack' in stored.get('selftest-revised', {}))
+
+        state['failIds'] = {'selftest-later'}  # a failed diff leaves the hash map as it was
+        with open(snapshot, 'w') as f:
+            json.dump([dict(new, date=new['date'] + 1, hash='selftest-later'), new] + feed, f)
+        indexed = dict(daemon.indexed)
+        quietly(daemon.run, cycles=1)
+        expect(results, 'daemon failed diff keeps the hash map', daemon.indexed == indexed and daemon.doneVersion['ingest'] != daemon.version, daemon.counts)
+        state['failIds'] = set()
+        clock.advance(daemon.nextRun['ingest'] - clock.now())
+        quietly(daemon.run, cycles=1)
+        expect(results, 'daemon failed diff re-sent', 'selftest-later' in stored and len(daemon.indexed) == len(indexed) + 1)
+
+        coalesced = daemon.counts['coalesced']
+        clock.advance(daemon.nextRun['ingest'] - clock.now())
+        daemon.ingest = lambda: clock.advance(200)  # overruns three 60s ticks
+        daemon.version += 1
+        quietly(daemon.run, cycles=1)
+        expect(results, 'daemon overrunning job coalesces missed ticks', daemon.counts['coalesced'] - coalesced == 2 and daemon.nextRun['ingest'] == clock.now(),
+               str(daemon.counts['coalesced'] - coalesced) + ' coalesced')
+
+        daemon.ingest = daemon.stop
+        daemon.version += 1
+        quietly(daemon.run)  # no cycle limit: only stop() ends it
+        expect(results, 'daemon stop', daemon.stopping)
+
+        try:
+            Covid_Daemon('covid-19', schedule={}, clock=clock, covid=daemon.covid)
+            rejected = False
+        except ValueError:
+            rejected = True
+        expect(results, 'daemon empty schedule rejected', rejected)
+    finally:
+        server.shutdown()
+        ES_Client.sharedClient = None  # the next client goes back to the configured hosts
+        if savedHosts is None:
+            os.environ.pop('ES_HOSTS', None)
+        else:
+            os.environ['ES_HOSTS'] = savedHosts
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+class StubFeed(http.server.BaseHTTPRequestHandler):  # upstream feed stand-in; the server's state holds the payload, its ETag and a request log
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        state = self.server.state
+        state['requests'].append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == state['etag']:
+            self.send_response(304)
+            self.send_header('ETag', state['etag'])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', state['etag'])
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(state['body'])))
+        self.end_headers()
+        self.wfile.write(state['body'])
+
+    def log_message(self, *args):
+        pass
+
+
+def checkFeed(results):
+    from app.dao.Feed_Client import Feed_Client
+
+    with open('data/source/covidExample.json', 'rb') as f:
+        body = f.read()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubFeed)
+    server.state = state = {'body': body, 'etag': '"v1"', 'requests': []}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tmp = tempfile.mkdtemp()
+    try:
+        url = 'http://127.0.0.1:' + str(server.server_port) + '/daily.json'
+        feed = Feed_Client(url=url, cacheDir=tmp, ttl=3600)
+        first = quietly(feed.load)
+        expect(results, 'feed first download', len(first) == len(json.loads(body)) and state['requests'] == [None] and os.path.exists(feed.cacheFile),
+               str(len(first)) + ' records, requests ' + str(state['requests']))
+
+        again = quietly(feed.load)
+        expect(results, 'feed ttl hit', again is first and len(state['requests']) == 1, str(len(state['requests'])) + ' requests')
+
+        feed.ttl = 0  # always revalidate
+        revalidated = quietly(feed.load)
+        expect(results, 'feed 304 keeps the same array', revalidated is first and state['requests'][-1] == '"v1"' and len(state['requests']) == 2, state['requests'])
+
+        docs = json.loads(body)
+        state['body'] = json.dumps(docs[:10]).encode()
+        state['etag'] = '"v2"'
+        changed = quietly(feed.load)
+        expect(results, 'feed changed upstream', changed is not first and len(changed) == 10 and len(state['requests']) == 3, str(len(changed)) + ' records')
+
+        server.shutdown()
+        server.server_close()
+        cached = quietly(feed.load)
+        expect(results, 'feed server down uses the cached copy', cached is changed and len(state['requests']) == 3, str(len(cached)) + ' records')
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def checkSources(results):
+    import time
+    from app.sources import streamSources, defaultFiles
+
+    files = {'population': defaultFiles['population'], 'cdc': defaultFiles['cdc']}
+    with open(files['population']) as f:
+        expected = sum(1 for _ in f) - 1
+    with open(files['cdc']) as f:
+        expected += sum(1 for _ in f) - 1
+    docs = list(streamSources(files, queueSize=2, chunkSize=5))
+    expect(results, 'sources full stream', len(docs) == expected and len({doc['hash'] for doc in docs}) == expected, str(len(docs)) + ' of ' + str(expected))
+
+    outcome = {}
+
+    def closeEarly():  # read a few documents from the big sources, then stop pulling like bulkInsert does after an error
+        stream = streamSources(defaultFiles, queueSize=2, chunkSize=5, putTimeout=5)
+        outcome['read'] = [next(stream) for _ in range(10)]
+        stream.close()
+        outcome['closed'] = True
+
+    started = time.time()
+    worker = threading.Thread(target=closeEarly, daemon=True)  # a hang leaves this thread behind instead of the selftest
+    worker.start()
+    worker.join(30)
+    expect(results, 'sources closed early without hanging', outcome.get('closed') and len(outcome['read']) == 10, '%.2fs' % (time.time() - started))
+
+
+checks = {'async': checkAsync, 'daemon': checkDaemon, 'feed': checkFeed, 'sources': checkSources}  # check name -> function(results)
+
+
+def run(names=None):  # run the named checks (all by default); returns the number of failed expectations
+    results = []
+    for name in names or list(checks):
+        if name not in checks:
+            expect(results, name, False, "unknown check (options: " + ", ".join(checks) + ")")
+            continue
+        try:
+            checks[name](results)
+        except Exception as ex:  # a check that blows up is a failure, the remaining checks still run
+            expect(results, name, False, repr(ex))
+    failed = [name for name, passed in results if not passed]
+    print(str(len(results) - len(failed)) + " passed, " + str(len(failed)) + " failed")
+    return len(failed)
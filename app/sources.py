@@ -0,0 +1,173 @@
+import csv
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from app.records import decode
+
+
+# Function: source adapters and a concurrent ingestion pipeline for every dataset under data/source
+#   Each adapter reads one dataset and yields documents normalized to a common schema:
+#       source      name of the adapter that produced the document (covidtracking, owid, cdc, population)
+#       date        YYYYmmdd integer (None for undated reference data)
+#       state       state digraph (covidtracking/cdc/population) or ISO country code (owid)
+#       name        display name of the state/country
+#       hash        stable document id (the upstream hash where one exists, otherwise sha1 of source|state|date|key)
+#       plus the source specific measures (positive, death, deathIncrease, ... ) under the covidtracking field names where they line up
+#       missing values are real nulls in every source (the covidtracking "None" strings are decoded as nulls, see app/records.py)
+#
+#   ingest()
+#       parses every requested source in its own process, streams the documents back in chunks through a bounded
+#       queue (workers block when the indexer falls behind) and feeds them straight into ES_Client.bulkInsert
+#       when the consumer stops early (a _bulk error, Ctrl-C) the queue is shut down and the workers exit instead of blocking
+#
+#   Use Case:
+#       ingest(ES_Client('covid-sources'), {'owid': 'data/source/owid-covid-data.csv', 'cdc': 'data/source/Provisional_...csv'})
+
+populationFile = 'data/source/populationByState_2019.csv'
+
+
+def makeHash(*parts):  # stable document id built from the identifying fields of a record
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+def toNumber(value):  # int/float value of a csv cell; None for blanks
+    if value is None or value == '' or value == 'None':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+
+def getStateNames():  # {'New York': 'NY', ...} from the population table
+    with open(populationFile) as statePop:
+        return {rows['name']: rows['digraph'] for rows in csv.DictReader(statePop)}
+
+
+def parseCovidTracking(fqp):  # covidtracking daily feed (json array); already carries state, date and hash
+    with open(fqp, 'rb') as feedFile:
+        covidAry = decode(feedFile.read())  # "None" sentinels become nulls, like the other sources
+    for record in covidAry:
+        doc = record.toDict()
+        doc['source'] = 'covidtracking'
+        if not doc.get('hash'):
+            doc['hash'] = makeHash('covidtracking', doc.get('state'), doc.get('date'))
+        yield doc
+
+
+def parseOWID(fqp):  # our world in data daily country series
+    with open(fqp, newline='') as owidFile:
+        for rows in csv.DictReader(owidFile):
+            date = int(rows['date'].replace('-', ''))
+            yield {
+                'source': 'owid',
+                'date': date,
+                'state': rows['iso_code'],
+                'name': rows['location'],
+                'positive': toNumber(rows['total_cases']),
+                'positiveIncrease': toNumber(rows['new_cases']),
+                'death': toNumber(rows['total_deaths']),
+                'deathIncrease': toNumber(rows['new_deaths']),
+                'totalTestResults': toNumber(rows['total_tests']),
+                'totalTestResultsIncrease': toNumber(rows['new_tests']),
+                'positivePerMillion': toNumber(rows['total_cases_per_million']),
+                'deathPerMillion': toNumber(rows['total_deaths_per_million']),
+                'testsUnits': rows['tests_units'] or None,
+                'hash': makeHash('owid', rows['iso_code'] or rows['location'], date),  # aggregates (World, International) have no iso_code
+            }
+
+
+def parseCDC(fqp):  # cdc provisional death counts; one document per state and indicator with a field per race/ethnicity group
+    stateNames = getStateNames()
+    with open(fqp, newline='') as cdcFile:
+        reader = csv.DictReader(cdcFile)
+        groups = [f for f in reader.fieldnames if f not in ('State', 'Indicator')]
+        for rows in reader:
+            doc = {
+                'source': 'cdc',
+                'date': None,
+                'state': stateNames.get(rows['State'], rows['State']),
+                'name': rows['State'],
+                'indicator': rows['Indicator'],
+            }
+            for group in groups:
+                doc[group] = toNumber(rows[group])
+            doc['hash'] = makeHash('cdc', doc['state'], rows['Indicator'])
+            yield doc
+
+
+def parsePopulation(fqp):  # 2019 population by state
+    with open(fqp, newline='') as statePop:
+        for rows in csv.DictReader(statePop):
+            yield {
+                'source': 'population',
+                'date': 20190701,
+                'state': rows['digraph'],
+                'name': rows['name'],
+                'population': toNumber(rows['population']),
+                'hash': makeHash('population', rows['digraph'], 2019),
+            }
+
+
+sources = {'covidtracking': parseCovidTracking, 'owid': parseOWID, 'cdc': parseCDC, 'population': parsePopulation}  # source name -> adapter
+
+defaultFiles = {
+    'owid': 'data/source/owid-covid-data.csv',
+    'cdc': 'data/source/Provisional_Death_Counts_for_Coronavirus_Disease__COVID-19___Weekly_State-Specific_Data_Updates.csv',
+    'population': populationFile,
+}
+
+
+def runAdapter(name, fqp, queue, chunkSize, putTimeout):  # worker process: parse one source and push its documents onto the queue in chunks
+    try:
+        chunk = []
+        for doc in sources[name](fqp):
+            chunk.append(doc)
+            if len(chunk) >= chunkSize:
+                queue.put(chunk, timeout=putTimeout)  # blocks while the queue is full; gives up once nobody has read for putTimeout seconds
+                chunk = []
+        if chunk:
+            queue.put(chunk, timeout=putTimeout)
+    finally:
+        try:
+            queue.put(name, timeout=putTimeout)  # a bare source name marks the end of that source (sent even when parsing fails)
+        except Exception:  # the consumer is gone (queue full or manager shut down): nothing is waiting for the marker
+            pass
+
+
+def streamSources(files, workers=None, queueSize=8, chunkSize=1000, putTimeout=60):  # parse every source concurrently and yield the merged document stream
+    manager = multiprocessing.Manager()
+    pool = ProcessPoolExecutor(max_workers=workers or len(files))
+    finished = False
+    try:
+        queue = manager.Queue(maxsize=queueSize)
+        futures = {name: pool.submit(runAdapter, name, fqp, queue, chunkSize, putTimeout) for name, fqp in files.items()}
+        remaining = len(futures)
+        while remaining > 0:
+            item = queue.get()
+            if isinstance(item, str):  # one source finished
+                remaining -= 1
+                if futures[item].exception() is not None:
+                    print(item + " failed: ", futures[item].exception())
+                continue
+            for doc in item:
+                yield doc
+        finished = True
+    finally:
+        # closed early (the indexer stopped pulling, an exception, Ctrl-C): shut the queue down first so workers blocked
+        # in queue.put fail instead of holding the pool open, and don't wait for them
+        manager.shutdown()
+        pool.shutdown(wait=finished, cancel_futures=True)
+
+
+def ingest(esClient, files=None, **kwargs):  # kwargs: workers='Optional: parser processes: defaults to one per source', queueSize='Optional: max chunks in flight: defaults to 8', chunkSize='Optional: docs per chunk: defaults to 1000', threads='Optional: parallel _bulk workers: defaults to 1'
+    files = files or defaultFiles
+    unknown = [name for name in files if name not in sources]
+    if unknown:
+        print("Unknown source(s): " + ", ".join(unknown) + " (options: " + ", ".join(sources) + ")")
+        return None
+    docs = streamSources(files, kwargs.get('workers'), kwargs.get('queueSize', 8), kwargs.get('chunkSize', 1000))
+    return esClient.bulkInsert('_doc', docs, chunkSize=kwargs.get('chunkSize', 1000), threads=kwargs.get('threads', 1))